@@ -2,5 +2,6 @@
 
 from structarray.rebin import RebHandler
 from structarray.info import MetaParser
+from structarray.parse.readelf import ParserReadELF
 
 import structarray.meta as meta
\ No newline at end of file
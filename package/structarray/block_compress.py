@@ -1,24 +1,126 @@
-#☺!/usr/bin/env python3
+#!/usr/bin/env python3
 
+"""
+.rbz is a compressed form of a .reb recording, any range of records can be decoded without
+reading the whole file.
+
+the blocks (one record each) are gathered by frames of keyframe_len blocks, the first block of
+a frame is kept as is, the next ones are xored with the previous one, then the frame is compressed.
+
+	header: magic, data_len, block_size, keyframe_len
+	frames
+	index: offset of each frame in the file, then the end of the last frame
+	footer: offset of the index, number of frames
+"""
+
+import struct
 import sys
+import zlib
+
+import numpy as np
+
+header_fmt = '<4sQQQ'
+footer_fmt = '<QQ'
+magic = b'RBZ1'
+
+def xor_delta(block) :
+	""" block is a (n, block_size) array of bytes, each line is xored with the previous one """
+	delta = block.copy()
+	delta[1:] ^= block[:-1]
+	return delta
 
-def block_compress(src_pth, block_size) :
-	prev = None
-	dst_pth = src_pth.with_suffix('.rez')
+def xor_undelta(delta) :
+	return np.bitwise_xor.accumulate(delta, axis=0)
+
+def get_block_size(src_pth, meta_pth=None) :
+	""" the size of a block is the size of the record, given by the mapping """
+	from structarray.meta import MetaReb
+	return MetaReb().load(src_pth.parent / "mapping.tsv" if meta_pth is None else meta_pth).sizeof
+
+def block_compress(src_pth, block_size=None, keyframe_len=64, level=6, dst_pth=None) :
+	if block_size is None :
+		block_size = get_block_size(src_pth)
+	dst_pth = src_pth.with_suffix('.rbz') if dst_pth is None else dst_pth
+
+	data_len = src_pth.stat().st_size
+	frame_size = block_size * keyframe_len
+
+	offset_lst = list()
 	with dst_pth.open('wb') as fid_w :
+		fid_w.write(struct.pack(header_fmt, magic, data_len, block_size, keyframe_len))
 		with src_pth.open('rb') as fid_r :
 			while True :
-				block = fid_r.read(block_size)
-				if len(block) == 0 :
+				frame = fid_r.read(frame_size)
+				if len(frame) == 0 :
 					break
-				if len(block) != block_size :
-					raise ValueError
-				if prev is not None :
-					block = bytes(x ^ y for x, y in zip(prev, block))
-				fid_w.write(block)
-				prev = block
+				if len(frame) % block_size != 0 :
+					frame += bytes(block_size - len(frame) % block_size) # the last block is completed with zeros
+				block = np.frombuffer(frame, dtype=np.uint8).reshape(-1, block_size)
+				offset_lst.append(fid_w.tell())
+				fid_w.write(zlib.compress(xor_delta(block).tobytes(), level))
+		index_offset = fid_w.tell()
+		fid_w.write(np.array(offset_lst + [index_offset,], dtype='<u8').tobytes())
+		fid_w.write(struct.pack(footer_fmt, index_offset, len(offset_lst)))
+
+	return dst_pth
+
+def block_decompress(src_pth, dst_pth=None) :
+	dst_pth = src_pth.with_suffix('.reb') if dst_pth is None else dst_pth
+	with BlockReader(src_pth) as u, dst_pth.open('wb') as fid_w :
+		for k in range(u.frame_nbr) :
+			fid_w.write(u.get_frame(k).tobytes()[:u.data_len - k * u.frame_size])
+	return dst_pth
+
+class BlockReader() :
+	""" random access to the blocks of a .rbz file, only the frames needed are decompressed """
+
+	def __init__(self, pth) :
+		self.pth = pth
+		self.fid = pth.open('rb')
+
+		self.magic, self.data_len, self.block_size, self.keyframe_len = struct.unpack(header_fmt, self.fid.read(struct.calcsize(header_fmt)))
+		if self.magic != magic :
+			raise ValueError(f"{pth} is not a .rbz file")
+		self.frame_size = self.block_size * self.keyframe_len
+
+		self.fid.seek(- struct.calcsize(footer_fmt), 2)
+		index_offset, self.frame_nbr = struct.unpack(footer_fmt, self.fid.read(struct.calcsize(footer_fmt)))
+		self.fid.seek(index_offset)
+		self.offset_arr = np.frombuffer(self.fid.read(8 * (self.frame_nbr + 1)), dtype='<u8').astype(np.int64)
+
+	def __len__(self) :
+		""" number of complete blocks """
+		return self.data_len // self.block_size
+
+	def get_frame(self, k) :
+		self.fid.seek(self.offset_arr[k])
+		frame = zlib.decompress(self.fid.read(self.offset_arr[k+1] - self.offset_arr[k]))
+		return xor_undelta(np.frombuffer(frame, dtype=np.uint8).reshape(-1, self.block_size))
+
+	def read(self, start=None, stop=None) :
+		""" the blocks start:stop, as a (n, block_size) array of bytes """
+		start, stop, null = slice(start, stop).indices(len(self))
+		stop = max(start, stop)
+		a, b = start // self.keyframe_len, -(-stop // self.keyframe_len)
+		if a == b :
+			return np.zeros((0, self.block_size), dtype=np.uint8)
+		block = np.concatenate([self.get_frame(k) for k in range(a, b)])
+		return block[start - a * self.keyframe_len:stop - a * self.keyframe_len]
+
+	def close(self) :
+		self.fid.close()
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) :
+		self.close()
 
 if __name__ == '__main__' :
 	from pathlib import Path
 
-	block_compress(Path(sys.argv[1]), 368608)
\ No newline at end of file
+	src_pth = Path(sys.argv[1])
+	if src_pth.suffix == '.rbz' :
+		block_decompress(src_pth)
+	else :
+		block_compress(src_pth, get_block_size(src_pth, Path(sys.argv[2]) if 2 < len(sys.argv) else None))
@@ -1,47 +1,285 @@
 #!/usr/bin/env python3
 
+import collections
 import hashlib
+import os
 
-import h5py
+import numpy as np
+
+try :
+	import h5py
+except ImportError :
+	h5py = None # only the MemoryCache is available
+
+class MemoryCache() :
+
+	""" least recently used cache of numpy arrays, kept in memory,
+	the total size of the arrays is bounded by max_size bytes
+	"""
+
+	def __init__(self, max_size=2**28) :
+		self.max_size = max_size
+		self.size = 0
+
+		self._m = collections.OrderedDict() # key -> array, the least recently used first
+
+		self.hit = 0
+		self.miss = 0
+		self.eviction = 0
+
+	def get(self, key, default=None) :
+		if key in self._m :
+			self._m.move_to_end(key)
+			self.hit += 1
+			return self._m[key]
+		self.miss += 1
+		return default
+
+	def __getitem__(self, key) :
+		if key not in self._m :
+			raise KeyError(key)
+		return self.get(key)
+
+	def __setitem__(self, key, value) :
+		if key in self._m :
+			self.size -= self._m.pop(key).nbytes
+		if self.max_size < value.nbytes :
+			return # would evict everything else
+		self._m[key] = value
+		self.size += value.nbytes
+		while self.max_size < self.size :
+			k, v = self._m.popitem(last=False)
+			self.size -= v.nbytes
+			self.eviction += 1
+
+	def __contains__(self, key) :
+		return key in self._m
+
+	def __len__(self) :
+		return len(self._m)
+
+	def open_writer(self, key_lst, dtype_lst, length) :
+		""" a MemoryWriter of the columns, restricted to the first ones which fit in the cache """
+		total, n = 0, 0
+		for dtype in dtype_lst :
+			total += length * dtype.itemsize
+			if self.max_size < total :
+				break
+			n += 1
+		return MemoryWriter(self, key_lst[:n], dtype_lst[:n], length)
+
+	def clear(self) :
+		self._m.clear()
+		self.size = 0
+
+	def close(self) :
+		self.clear()
+
+	def stats(self) :
+		return {
+			'hit' : self.hit,
+			'miss' : self.miss,
+			'eviction' : self.eviction,
+			'count' : len(self._m),
+			'size' : self.size,
+		}
 
 class CacheHandler() :
 
-	""" simple cache function, with a single optimisation :
+	""" two tier cache of columns, a MemoryCache of at most max_size bytes on top of an hdf5 file :
 	- lines which have the same hash will not be duplicated
+	- the file is bound to its source by a signature, it is cleared if the signature changed
+	- the file is opened for each access only, so that it can be shared with other processes. when it
+	  is busy, a read is a miss and a write is kept in memory only
 	"""
 
-	def __init__(self, cache_pth) :
+	h5py_opt = { # fast, the cache is meant to be faster than the recording
+		'compression' : "lzf",
+		'shuffle' : True,
+	}
+
+	def __init__(self, cache_pth, signature=None, max_size=2**30) :
+
+		if h5py is None :
+			raise ModuleNotFoundError("h5py is needed for a cache on file")
 
 		self.hdf_pth = cache_pth.resolve()
-		# self.hsh_pth = self.hdf_pth.with_suffix(".tsv")
+		self.signature = signature
 
-		self.key_map = dict() # key -> hsh
-		self.hsh_map = dict() # hsh -> key
+		self.memory = MemoryCache(max_size)
 
-		if self.hdf_pth.is_file() :
-			with h5py.File(self.hdf_pth, 'r', libver="latest") as obj :
-				self.key_map = {
-					key : obj.attrs[key] for key in obj.attrs.keys()
-				}
-				self.hsh_map = {
-					obj.attrs[key] : key for key in obj.attrs.keys()
-				}
+		self.hit = 0 # read from the file
+		self.miss = 0
+		self.busy = 0 # accesses which failed because the file was in use
+
+		with h5py.File(self.hdf_pth, 'a', libver="latest") as obj :
+			is_outdated = signature is not None and obj.attrs.get('_signature', signature) != signature
+		if is_outdated :
+			# hdf5 does not give back the space of deleted datasets, the file is created again
+			print(f"! {self.hdf_pth} was built for another recording or mapping, it is cleared")
+			with h5py.File(self.hdf_pth, 'w', libver="latest") as obj :
+				pass
+		with h5py.File(self.hdf_pth, 'a', libver="latest") as obj :
+			if signature is not None :
+				obj.attrs['_signature'] = signature
+			self.key_map = { # key -> hsh
+				key : obj.attrs[key] for key in obj.attrs.keys() if key != '_signature'
+			}
+		self.hsh_map = { # hsh -> key
+			hsh : key for key, hsh in self.key_map.items()
+		}
+
+	def get(self, key, default=None) :
+		""" the column of key, or default if it is not in the cache, or if the file is busy """
+		value = self.memory.get(key)
+		if value is None :
+			try :
+				with h5py.File(self.hdf_pth, 'r', libver="latest") as obj :
+					if not self._is_mine(obj) :
+						self.key_map.clear() # the file was created again, for another recording
+					elif key not in self.key_map and key in obj.attrs :
+						self.key_map[key] = obj.attrs[key] # written by another handler
+					if key not in self.key_map :
+						self.miss += 1
+						return default
+					value = obj[self.key_map[key]][...]
+			except OSError :
+				self.busy += 1
+				return default
+			self.hit += 1
+			value.flags.writeable = False
+			self.memory[key] = value
+		return value
 
 	def __getitem__(self, key) :
-		with h5py.File(self.hdf_pth, 'r', libver="latest") as obj :
-			return obj[self.key_map[key]][...]
+		value = self.get(key)
+		if value is None :
+			raise KeyError(key)
+		return value
 
 	def __setitem__(self, key, value) :
-		hsh = hashlib.blake2b(value.tobytes(), digest_size=24).hexdigest()
+		""" value is copied, the copy is kept read-only in memory """
+		value = np.array(value, order='C')
+		hsh = hashlib.blake2b((value.dtype.str + str(value.shape)).encode('ascii'), digest_size=24) # same bytes, other shape
+		hsh.update(value.data) # no copy of the bytes
+		hsh = hsh.hexdigest()
 
-		with h5py.File(self.hdf_pth, 'a', libver="latest") as obj :
-			if hsh not in self.hsh_map :
-				obj.create_dataset('/' + hsh, data=value, ** self.h5py_opt)
-				obj.attrs[key] = hsh
+		try :
+			with h5py.File(self.hdf_pth, 'a', libver="latest") as obj :
+				if self._is_mine(obj) :
+					if hsh not in obj :
+						obj.create_dataset('/' + hsh, data=value, ** self.h5py_opt)
+					obj.attrs[key] = hsh
+					self.key_map[key] = hsh
+					self.hsh_map[hsh] = key
+		except OSError :
+			self.busy += 1
+
+		value.flags.writeable = False
+		self.memory[key] = value
+
+	def open_writer(self, key_lst, dtype_lst, length) :
+		""" a FileWriter, the columns are written in the file chunk by chunk """
+		return FileWriter(self, key_lst, dtype_lst, length)
+
+	def _is_mine(self, obj) :
+		return self.signature is None or obj.attrs.get('_signature', self.signature) == self.signature
 
-		self.key_map[key] = hsh
-		self.hsh_map[hsh] = key
-			
 	def __contains__(self, key) :
-		return key in self.key_map
+		""" True if the column was known when the file was last read, get() can still miss it if
+		the file is busy """
+		return key in self.memory or key in self.key_map
+
+	def close(self) :
+		self.memory.clear()
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) :
+		self.close()
+
+	def stats(self) :
+		return {
+			'memory' : self.memory.stats(),
+			'file' : {
+				'hit' : self.hit,
+				'miss' : self.miss,
+				'busy' : self.busy,
+				'count' : len(self.key_map),
+				'unique' : len(set(self.key_map.values())),
+			},
+		}
+
+class MemoryWriter() :
+
+	""" fill columns of length records chunk by chunk, see FileWriter, they are given to the
+	MemoryCache once complete """
+
+	def __init__(self, cache, key_lst, dtype_lst, length) :
+		self.cache = cache
+		self.key_lst = list(key_lst)
+		self.out_map = {key : np.empty((length,), dtype=dtype) for key, dtype in zip(key_lst, dtype_lst)}
+
+	def write(self, i, rec) :
+		""" write the records i:i+len(rec) of each column, rec[key] gives the values of a key """
+		for key, out in self.out_map.items() :
+			value = rec[key]
+			out[i:i + len(value)] = value
+
+	def commit(self) :
+		for key, out in self.out_map.items() :
+			out.flags.writeable = False
+			self.cache[key] = out
+		self.out_map = dict()
+
+	def abort(self) :
+		self.out_map = dict()
+
+class FileWriter() :
+
+	""" fill columns of length records in the file of a CacheHandler, chunk by chunk, none of them is
+	kept in memory. the columns are written in temporary datasets, hashed on the fly, and stored
+	under their hash once complete, see CacheHandler.__setitem__ """
+
+	def __init__(self, cache, key_lst, dtype_lst, length) :
+		self.cache = cache
+		self.key_lst = list(key_lst)
+
+		self.tmp_map = dict() # key -> temporary dataset
+		self.hsh_map = dict() # key -> hash object
+		with h5py.File(self.cache.hdf_pth, 'a', libver="latest") as obj :
+			if not self.cache._is_mine(obj) :
+				raise OSError(f"{self.cache.hdf_pth} was created again for another recording")
+			for i, (key, dtype) in enumerate(zip(self.key_lst, dtype_lst)) :
+				tmp = f'/_tmp_{os.getpid()}_{id(self)}_{i}'
+				obj.create_dataset(tmp, shape=(length,) + dtype.shape, dtype=dtype.base, ** self.cache.h5py_opt)
+				self.tmp_map[key] = tmp
+				self.hsh_map[key] = hashlib.blake2b((dtype.base.str + str((length,) + dtype.shape)).encode('ascii'), digest_size=24) # as in __setitem__
+
+	def write(self, i, rec) :
+		""" write the records i:i+len(rec) of each column, rec[key] gives the values of a key """
+		with h5py.File(self.cache.hdf_pth, 'a', libver="latest") as obj :
+			for key, tmp in self.tmp_map.items() :
+				value = np.ascontiguousarray(rec[key])
+				obj[tmp][i:i + len(value)] = value
+				self.hsh_map[key].update(value.data)
+
+	def commit(self) :
+		with h5py.File(self.cache.hdf_pth, 'a', libver="latest") as obj :
+			for key, tmp in self.tmp_map.items() :
+				hsh = self.hsh_map[key].hexdigest()
+				if hsh in obj :
+					del obj[tmp]
+				else :
+					obj.move(tmp, '/' + hsh)
+				obj.attrs[key] = hsh
+				self.cache.key_map[key] = hsh
+				self.cache.hsh_map[hsh] = key
+		self.tmp_map = dict()
 
+	def abort(self) :
+		with h5py.File(self.cache.hdf_pth, 'a', libver="latest") as obj :
+			for tmp in self.tmp_map.values() :
+				del obj[tmp]
+		self.tmp_map = dict()
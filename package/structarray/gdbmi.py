@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import ast
+import re
+import subprocess
+import threading
+
+result_rec = re.compile(r'''^(?P<token>\d+)\^(?P<cls>done|error|running|connected|exit)(,msg=(?P<msg>"(?:[^"\\]|\\.)*"))?''')
+
+class GdbError(Exception) :
+	def __init__(self, cmd, msg) :
+		self.cmd = cmd
+		self.msg = msg
+		Exception.__init__(self, f"{cmd} => {msg}")
+
+class GdbStopped(ValueError) :
+	""" the gdb process ended before answering all the commands """
+	pass
+
+def mi_quote(cmd) :
+	return '"' + cmd.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def mi_unquote(s) :
+	return ast.literal_eval(s)
+
+class GdbSession() :
+
+	""" a single gdb process, driven through the machine interface, the symbols of the elf are loaded once.
+	the commands are written to gdb by a thread while the answers are read back, so that a long list of
+	commands does not dead lock on the pipes
+	"""
+
+	setup_lst = [
+		"set pagination off",
+		"set width 0",
+		"set height 0",
+		"set confirm off",
+		"set max-value-size unlimited",
+	]
+
+	def __init__(self, elf_pth) :
+		self.elf_pth = elf_pth
+		self.proc = None
+		self.token = 0
+
+	def start(self) :
+		if self.proc is None :
+			self.proc = subprocess.Popen(
+				['gdb', '-q', '-nx', '--interpreter=mi2', str(self.elf_pth)],
+				stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+				text=True, errors='replace', bufsize=2**16
+			)
+			self.run(* self.setup_lst)
+		return self
+
+	def run(self, * cmd_lst, strict=True) :
+		""" return the console output of each command, in order.
+		if a command fails, a GdbError is raised once all the answers are read, or, if strict is False,
+		the GdbError takes the place of the output in the list
+		"""
+		if self.proc is None :
+			self.start()
+
+		cmd_lst = list(cmd_lst)
+		first = self.token + 1
+		self.token += len(cmd_lst)
+
+		def write() :
+			try :
+				for i, cmd in enumerate(cmd_lst) :
+					self.proc.stdin.write(f"{first + i}-interpreter-exec console {mi_quote(cmd)}\n")
+				self.proc.stdin.flush()
+			except BrokenPipeError :
+				pass # gdb died, the reader will tell
+
+		writer = threading.Thread(target=write, daemon=True)
+		writer.start()
+
+		out_lst = [None,] * len(cmd_lst)
+		stack = list()
+		n = 0
+		while n < len(cmd_lst) :
+			line = self.proc.stdout.readline()
+			if not line :
+				raise GdbStopped(f"gdb stopped after {n} of {len(cmd_lst)} commands")
+			if line.startswith('~') :
+				stack.append(mi_unquote(line[1:].strip()))
+			elif (result_res := result_rec.match(line)) is not None :
+				i = int(result_res.group('token')) - first
+				if not 0 <= i < len(cmd_lst) :
+					continue
+				if result_res.group('cls') == 'error' :
+					msg = mi_unquote(result_res.group('msg')) if result_res.group('msg') else ''
+					out_lst[i] = GdbError(cmd_lst[i], msg.strip())
+				else :
+					out_lst[i] = ''.join(stack)
+				stack = list()
+				n += 1
+			# everything else, prompts, logs and notifications, is ignored
+
+		writer.join()
+
+		if strict :
+			for out in out_lst :
+				if isinstance(out, GdbError) :
+					raise out
+
+		return out_lst
+
+	def close(self) :
+		if self.proc is not None :
+			try :
+				self.proc.stdin.write("-gdb-exit\n")
+				self.proc.stdin.flush()
+				self.proc.wait(timeout=10)
+			except (BrokenPipeError, subprocess.TimeoutExpired) :
+				self.proc.kill()
+			self.proc = None
+
+	def __enter__(self) :
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback) :
+		self.close()
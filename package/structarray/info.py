@@ -1,16 +1,72 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import hashlib
+import os
 import re
-import subprocess
+import struct
 import sys
-import hashlib
 
 from cc_pathlib import Path
 
+from structarray.gdbmi import GdbSession, GdbError, GdbStopped
+
 struct_rec = re.compile(r'''struct\s*\{(?P<member>.*?)\}''', re.MULTILINE | re.DOTALL)
-array_rec = re.compile(r'(?P<ctype>.*?)\s*\[(?P<array>\d+)\]')
+array_rec = re.compile(r'(?P<ctype>.*?)\s*(?P<array>(\[\d+\])+)$')
 addr_rec = re.compile(r'''\$[0-9]+ = (?P<addr>0x[0-9a-f]+)''')
-member_rec = re.compile(r'''\s*(?P<ctype>.*?)\b\s*(?P<pointer>\*)?\s*\b(?P<name>[a-zA-Z_][a-zA-Z0-9_]*)(\[(?P<array>\d+)\])?\s*;''')
+member_rec = re.compile(r'''\s*(?P<ctype>.*?)\b\s*(?P<pointer>\*)?\s*\b(?P<name>[a-zA-Z_][a-zA-Z0-9_]*)(?P<array>(\[\d+\])+)?\s*;''')
+index_rec = re.compile(r'\[(?P<size>\d+)\]')
+typedef_rec = re.compile(r'\.(\[\d+\])+') # the sizes of a typedef'd array, once the path is joined
+
+def at_index(path, index) :
+	""" replace the sizes of the arrays found in path by the indices given """
+	index = iter(index)
+	return index_rec.sub(lambda index_res : f'[{next(index)}]', path)
+
+def elf_digest(pth) :
+	""" the build-id of the elf if it has one, else a digest of its content """
+	with pth.open('rb') as fid :
+		ident = fid.read(16)
+		if ident[:4] == b'\x7fELF' :
+			end = '<' if ident[5] == 1 else '>'
+			if ident[4] == 2 : # 64 bits
+				fid.seek(0x28)
+				shoff, = struct.unpack(end + 'Q', fid.read(8))
+				fid.seek(0x3a)
+				shentsize, shnum = struct.unpack(end + 'HH', fid.read(4))
+				sh_fmt = end + 'IIQQQQ' # name, type, flags, addr, offset, size
+			else :
+				fid.seek(0x20)
+				shoff, = struct.unpack(end + 'I', fid.read(4))
+				fid.seek(0x2e)
+				shentsize, shnum = struct.unpack(end + 'HH', fid.read(4))
+				sh_fmt = end + 'IIIIII'
+			for i in range(shnum) :
+				fid.seek(shoff + i * shentsize)
+				null, sh_type, null, null, sh_offset, sh_size = struct.unpack(sh_fmt, fid.read(struct.calcsize(sh_fmt)))
+				if sh_type != 7 : # SHT_NOTE
+					continue
+				fid.seek(sh_offset)
+				note = fid.read(sh_size)
+				j = 0
+				while j + 12 <= len(note) :
+					namesz, descsz, n_type = struct.unpack(end + 'III', note[j:j+12])
+					name = note[j+12:j+12+namesz]
+					k = j + 12 + (-(-namesz // 4) * 4)
+					if n_type == 3 and name == b'GNU\x00' : # NT_GNU_BUILD_ID
+						return 'b' + note[k:k+descsz].hex()
+					j = k + (-(-descsz // 4) * 4)
+		fid.seek(0)
+		hsh = hashlib.blake2b(digest_size=20)
+		while (chunk := fid.read(2**24)) :
+			hsh.update(chunk)
+		return 'h' + hsh.hexdigest()
+
+def get_cache_dir() :
+	""" where the results of MetaParser are kept, $STRUCTARRAY_CACHE if defined """
+	if 'STRUCTARRAY_CACHE' in os.environ :
+		return Path(os.environ['STRUCTARRAY_CACHE'])
+	return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'structarray'
 
 def unp(s) :
 	return s.replace('.*' , '->')
@@ -28,13 +84,24 @@ class MetaParser() :
 	_debug = True
 	version = 2
 
-	def __init__(self, elf_pth) :
+	shard_len = 2**10 # a list of commands is split among the gdb workers by shards of at least this length
+
+	def __init__(self, elf_pth, cache_dir=None, worker_nbr=None) :
+
+		self.elf_pth = elf_pth.resolve()
+
+		# a pool of gdb sessions, the workers beyond the first are started only for long lists of commands
+		self.gdb_lst = [GdbSession(self.elf_pth) for k in range(max(1, os.cpu_count() if worker_nbr is None else worker_nbr))]
+
+		# the results are kept in a directory of the cache named after the build of the elf
+		self.cache_root = get_cache_dir() if cache_dir is None else Path(cache_dir)
+		self.digest = elf_digest(self.elf_pth)
+		self.cache_dir = self.cache_root / self.digest
+		self.cache_dir.mkdir(parents=True, exist_ok=True)
 
 		if self._debug :
-			self.log_pth = Path("debug.log")
+			self.log_pth = self.cache_dir / "debug.log"
 			self.log_pth.write_text('')
-			
-		self.elf_pth = elf_pth.resolve()
 
 		self.addr = list()
 		self.tree = dict()
@@ -43,32 +110,50 @@ class MetaParser() :
 		
 		# self.ctype_pth = (self.elf_pth.parent / "structarray_ctype.json") if ctype_pth is None else ctype_pth
 		self.ctype_map = dict() # self.ctype_pth.load()
-		self.ctype_map['void*'] = 'P' + str(self.get_sizeof('void*'))
-
-	def _gdb(self, * cmd_lst, chunk_size=2**12, unlimited_size=False) :
+		self.sizeof_map = dict() # ctype -> size, as given by gdb
 
-		cmd_lst = list(cmd_lst)
-		stack = list()
-
-		chunk = cmd_lst[:chunk_size]
-		while chunk :
-			print(f'\t{len(cmd_lst)}')
-			line = ['gdb', str(self.elf_pth), '-batch',]
-			if unlimited_size :
-				line += ['-ex', "set max-value-size unlimited"]
-			for cmd in chunk :
-				line += ['-ex', cmd]
-
-			if self._debug :
-				print(' '.join(line[3:])[:92])
-
-			ret = subprocess.run(line, stdout=subprocess.PIPE)
-			stack.append(ret.stdout.decode(sys.stdout.encoding))
-
-			cmd_lst = cmd_lst[chunk_size:]
-			chunk = cmd_lst[:chunk_size]
+	def _gdb(self, * cmd_lst, strict=True) :
+		""" run the commands in the gdb sessions of the elf, one output per command, in order.
+		the commands are split in contiguous shards, one per worker, run at the same time """
+		print(f'\t{len(cmd_lst)}')
+		if self._debug :
+			print(' '.join(cmd_lst)[:92])
 
-		return ''.join(stack)
+		n = max(1, min(len(self.gdb_lst), -(-len(cmd_lst) // self.shard_len)))
+		if n == 1 :
+			out_lst = self._run(0, cmd_lst)
+		else :
+			bound = [len(cmd_lst) * k // n for k in range(n + 1)]
+			with concurrent.futures.ThreadPoolExecutor(n) as pool :
+				job_lst = [pool.submit(self._run, k, cmd_lst[bound[k]:bound[k+1]]) for k in range(n)]
+				out_lst = [out for job in job_lst for out in job.result()]
+
+		if strict :
+			for out in out_lst :
+				if isinstance(out, GdbError) :
+					raise out
+		return out_lst
+
+	def _run(self, k, cmd_lst) :
+		""" run a shard of commands on the worker k, a worker whose gdb stopped is started again once,
+		the commands which fail are given back as GdbError """
+		try :
+			return self.gdb_lst[k].run(* cmd_lst, strict=False)
+		except GdbStopped :
+			print(f"! gdb worker {k} stopped, it is started again", file=sys.stderr)
+			self.gdb_lst[k].close()
+			self.gdb_lst[k] = GdbSession(self.elf_pth)
+			return self.gdb_lst[k].run(* cmd_lst, strict=False)
+
+	def close(self) :
+		for gdb in self.gdb_lst :
+			gdb.close()
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) :
+		self.close()
 
 	def path_walk(self, pname, ctype=None, follow_pointers=False) :
 		pass
@@ -100,34 +185,38 @@ class MetaParser() :
 	def get_addr(self, * path_lst, relative_to=0) :
 		print(f">>> StructInfo.get_addr( {len(path_lst)} )", file=sys.stderr)
 
-		line_lst = self._gdb(* [f'p/a &({unp(path)})' for path in path_lst]).splitlines()
-		addr_lst = list()
-		for line in line_lst :
-			if 'no member named' in line :
-				print(path_lst)
-				raise
-			addr_res = addr_rec.search(line)
-			addr_lst.append(int(addr_res.group('addr'), 16) - relative_to)
-		return addr_lst
+		out_lst = self._gdb(* [f'p/a &({unp(path)})' for path in path_lst], strict=False)
+
+		fail_lst = [f"{path}: {out.msg}" for path, out in zip(path_lst, out_lst) if isinstance(out, GdbError)]
+		if fail_lst :
+			raise ValueError(f"StructInfo.get_addr() {len(fail_lst)} paths failed\n" + '\n'.join(fail_lst[:16]))
+
+		return [int(addr_rec.search(out).group('addr'), 16) - relative_to for out in out_lst]
 
 	def get_tree(self, * ctype_lst) :
 		print(f">>> StructInfo.get_tree( {len(ctype_lst)} )", file=sys.stderr)
 
 		new_set = set()
 
-		line = self._gdb(* [f'ptype {ctype}' for ctype in ctype_lst], unlimited_size=True)
-		ptype_lst = [item.strip() for item in line.split('type =') if item.strip()]
+		out_lst = self._gdb(* [f'ptype {ctype}' for ctype in ctype_lst])
+		ptype_lst = [out.partition('type =')[-1].strip() for out in out_lst]
 
 		if self._debug :
 			with self.log_pth.open('at') as fid :
 				fid.write(">"*8 + '\n')
 				fid.write('\n'.join(ctype_lst) + '\n')
 				fid.write("-"*8 + '\n')
-				fid.write(line)
+				fid.write(''.join(out_lst))
 				# fid.write("-"*8 + '\n')
 				# fid.write('\n'.join(ptype_lst) + '\n')
 				fid.write("<"*8 + '\n')
 
+		# the sizes of all the new scalar types are asked at once
+		self.get_sizeof(* [
+			ptype for ptype in ptype_lst
+			if struct_rec.match(ptype) is None and array_rec.match(ptype) is None and ptype not in self.ctype_map
+		])
+
 		for ctype, ptype in zip(ctype_lst, ptype_lst) :
 
 			if self._debug :
@@ -141,16 +230,12 @@ class MetaParser() :
 						if member_res.group('ctype') not in ["void",] :
 							struct_lst.append([member_res.group('ctype').strip(), (member_res.group('pointer') is not None), member_res.group('name')])
 					else :
-						for i in range(int(member_res.group('array'))) :
-							struct_lst.append([member_res.group('ctype').strip(), (member_res.group('pointer') is not None), member_res.group('name') + f'[{i}]'])
+						# an array is a single member, named with its sizes, the elements are not expanded
+						struct_lst.append([member_res.group('ctype').strip(), (member_res.group('pointer') is not None), member_res.group('name') + member_res.group('array')])
 				self.tree[ctype] = struct_lst
 				new_set |= set(c for c, p, m in struct_lst)
 			elif (array_res := array_rec.match(ptype)) is not None :
-				array_lst = list()
-				array_size = int(array_res.group('array'))
-				for i in range(array_size) :
-					array_lst.append([array_res.group('ctype').strip(), False, f'[{i}]'])
-				self.tree[ctype] = array_lst
+				self.tree[ctype] = [[array_res.group('ctype').strip(), False, array_res.group('array')],]
 				new_set.add(array_res.group('ctype').strip())
 			else :
 				if ptype not in self.ctype_map :
@@ -170,15 +255,33 @@ class MetaParser() :
 
 		return new_set
 
-	def get_sizeof(self, ctype) :
-		line = self._gdb(f'print sizeof({ctype})')
-		left, sep, right = line.partition('=')
-		return int(right.strip())
+	def get_sizeof(self, * ctype_lst) :
+		""" the sizes are kept, each ctype is asked only once to gdb """
+		todo_lst = sorted(set(ctype_lst) - self.sizeof_map.keys())
+		if todo_lst :
+			for ctype, out in zip(todo_lst, self._gdb(* [f'print sizeof({ctype})' for ctype in todo_lst])) :
+				left, sep, right = out.partition('=')
+				self.sizeof_map[ctype] = int(right.strip())
+		if len(ctype_lst) == 1 :
+			return self.sizeof_map[ctype_lst[0]]
+		return [self.sizeof_map[ctype] for ctype in ctype_lst]
 
 	def parse(self, var_name) :
+		""" an elf already parsed is read back from the cache. if another build of the elf was parsed
+		before, only the addresses below the types whose layout changed are asked to gdb """
+
+		cache_pth = self.cache_dir / f"{var_name}.json"
+		if cache_pth.is_file() and (cache := cache_pth.load()).get('version') == self.version :
+			for key in ['var_name', 'var_type', 'var_size', 'tree', 'ctype_map', 'sizeof_map', 'addr'] :
+				setattr(self, key, cache[key])
+			print(f"sizeof({self.var_type}) = {self.var_size}, from {cache_pth}")
+			return self.var_size
+
+		if 'void*' not in self.ctype_map :
+			self.ctype_map['void*'] = 'P' + str(self.get_sizeof('void*'))
 
-		line = self._gdb(f'whatis {var_name}')
-		if line.startswith('type =') :
+		line = self._gdb(f'whatis {var_name}', strict=False).pop()
+		if isinstance(line, str) and line.startswith('type =') :
 			var_type = line.partition('=')[-1].strip()
 		else :
 			raise ValueError(f"this var is not known: {var_name}")
@@ -187,8 +290,10 @@ class MetaParser() :
 
 		origin = self.get_addr(var_name).pop()
 
+		prev = self.load_previous(var_name)
+
 		self.parse_tree(var_name, var_type)
-		self.parse_addr(var_name, var_type, origin)
+		self.parse_addr(var_name, var_type, origin, prev)
 
 		self.var_name = var_name
 		self.var_type = var_type
@@ -196,36 +301,78 @@ class MetaParser() :
 
 		print(f"sizeof({var_type}) = {var_size}")
 
+		cache_pth.save({
+			'version' : self.version,
+			'elf' : str(self.elf_pth),
+			** {key : getattr(self, key) for key in ['var_name', 'var_type', 'var_size', 'tree', 'ctype_map', 'sizeof_map', 'addr']}
+		})
+		(self.cache_root / f"{var_name}.last").write_text(self.digest)
+
 		return var_size
 
+	def load_previous(self, var_name) :
+		""" the cache of the last build in which var_name was parsed, if any """
+		last_pth = self.cache_root / f"{var_name}.last"
+		if not last_pth.is_file() :
+			return None
+		cache_pth = self.cache_root / last_pth.read_text().strip() / f"{var_name}.json"
+		if not cache_pth.is_file() or (cache := cache_pth.load()).get('version') != self.version :
+			return None
+		return cache
+
+	def get_same_set(self, prev) :
+		""" the ctypes whose layout is the same as in the previous build: same members, of the same
+		types, recursively, and the same size """
+		same_map = dict()
+		def is_same(ctype) :
+			if ctype not in same_map :
+				same_map[ctype] = False
+				new, old = self.tree.get(ctype), prev['tree'].get(ctype)
+				if new is None or new != old :
+					same_map[ctype] = False
+				elif isinstance(new, list) :
+					same_map[ctype] = self.sizeof_map.get(ctype) == prev['sizeof_map'].get(ctype) and all(is_same(c) for c, p, m in new if not p)
+				else :
+					same_map[ctype] = self.ctype_map.get(new) == prev['ctype_map'].get(new)
+			return same_map[ctype]
+		return set(ctype for ctype in self.tree if is_same(ctype))
+
+	def walk_anchor(self, same_set, ctype, path_lst=None) :
+		""" same as walk(), without following pointers, the length of the path to the first type
+		of same_set met is given with each leaf, None if there is none """
+		if path_lst is None :
+			path_lst = list()
+		anchor = len(path_lst) if ctype in same_set else None
+		for line, a in self._walk_anchor(same_set, ctype, path_lst) :
+			yield line, (a if anchor is None else anchor)
+
+	def _walk_anchor(self, same_set, ctype, path_lst) :
+		if isinstance(self.tree[ctype], list) :
+			for c, p, m in self.tree[ctype] :
+				if p :
+					yield path_lst + [m, 'void*'], None
+				else :
+					yield from self.walk_anchor(same_set, c, path_lst + [m,])
+		else :
+			yield path_lst + [self.tree[ctype],], None
+
+	def get_meta(self, name=None) :
+		from structarray.meta import MetaReb
+		u = MetaReb(self.var_name if name is None else name, self.var_size)
+		for line in self.addr :
+			u.push(* line)
+		return u
+
 	def save_absolute(self, pth) :
 		pth.with_suffix('.tree.json').save(self.tree, verbose=True)
-		pth.with_suffix('.tsv').save([[self.var_type, self.var_size],] + self.addr)
+		self.get_meta(self.var_type).dump(pth.with_suffix('.tsv'), False)
 
 	def save_relative(self, pth) :
 		pth.with_suffix('.json').save(self.tree)
-
-		s_lst = list()
-		prev_addr = 0
-		for name, ctype, curr_addr in self.addr :
-			if s_lst :
-				u = curr_addr - prev_addr - int(s_lst[-1][1][1:])
-				if u != 0 :
-					s_lst[-1].append(u)
-			s_lst.append([name, ctype,])
-			prev_addr = curr_addr
-
-		u = self.var_size - prev_addr - int(s_lst[-1][1][1:])
-		if u != 0 :
-			s_lst[-1].append(u)
-
-		pth.with_suffix('.tsv').save([[self.var_type, self.var_size],] + s_lst)
+		self.get_meta(self.var_type).dump(pth.with_suffix('.tsv'), True)
 
 	def save(self, pth) :
-		from structarray.meta import MetaReb
-		u = MetaReb(self.var_name, self.var_size)
-		for name, mtype, addr in self.addr :
-			u.push(name, mtype, addr)
+		u = self.get_meta()
 		u.dump(pth.with_suffix('.map.tsv'), True, True)
 		u.dump(pth.with_suffix('.abs.tsv'))
 
@@ -242,24 +389,53 @@ class MetaParser() :
 		while todo_set :
 			todo_set = ( todo_set | self.get_tree(* sorted(todo_set)) ) - self.tree.keys()
 
-	def parse_addr(self, vname, ctype, origin=0) :
+		# the size of the structures, to tell if their layout changed from one build to the other
+		self.get_sizeof(* [c for c in self.tree if isinstance(self.tree[c], list)])
 
-		line_lst = list(self.walk(ctype))
-		name_lst = [ unp('.'.join(line[:-1])) for line in line_lst ]
-		path_lst = [ unp(f'{vname}.' + '.'.join(line[:-1])).replace('.[', '[') for line in line_lst ]
-		type_lst = [ line[-1] for line in line_lst ]
+	def parse_addr(self, vname, ctype, origin=0, prev=None) :
+		""" the address of each scalar is asked to gdb. an array is not expanded, the address of
+		its first element is asked, then the one of the second element along each dimension, which
+		gives the strides. below a type whose layout did not change since the previous build, only
+		the first scalar is asked, the others are moved by the same amount """
 
-		cache_pth = Path("tmp.addr_lst.json")
+		same_set = self.get_same_set(prev) if prev is not None else set()
+		old_map = {line[0] : line for line in prev['addr']} if prev is not None else dict()
 
-		if cache_pth.is_file() :
-			addr_lst = cache_pth.load()
-		else :
-			addr_lst = self.get_addr(* path_lst, relative_to=origin)
-			cache_pth.save(addr_lst)
+		leaf_lst = list() # name, gdb path, ptype, anchor
+		for line, anchor in self.walk_anchor(same_set, ctype) :
+			name = unp('.'.join(line[:-1]))
+			path = unp(f'{vname}.' + '.'.join(line[:-1])).replace('.[', '[')
+			name = typedef_rec.sub(lambda m : index_rec.sub(r'@\g<size>', m.group(0)[1:]), name) # .[n] => @n
+			key = tuple(line[:anchor]) if (anchor is not None and name in old_map) else None
+			leaf_lst.append((name, path, line[-1], key))
+
+		first_map = dict() # anchor -> the first leaf below, the only one asked
+		query_lst = list() # the gdb paths, for each variable, its first element then one per dimension
+		for name, path, ptype, key in leaf_lst :
+			if key is None or first_map.setdefault(key, name) == name :
+				shape = [int(i) for i in index_rec.findall(path)]
+				query_lst.append(at_index(path, [0,] * len(shape)))
+				for k in range(len(shape)) :
+					query_lst.append(at_index(path, [int(k == i) for i in range(len(shape))]))
 
-		Path("tmp.ctype_map.json", verbose=True).save(self.ctype_map)
+		if prev is not None :
+			print(f"{len(leaf_lst) - len(first_map)} addresses out of {len(leaf_lst)} moved from the previous build")
 
-		self.addr = [
-			[ re.sub(r'\.\[(?P<array>\d+)\]', r'@\g<array>', name), self.ctype_map[ptype], addr ]
-			for name, ptype, addr in zip(name_lst, type_lst, addr_lst)
-		]
+		addr_itr = iter(self.get_addr(* query_lst, relative_to=origin) if query_lst else [])
+
+		self.addr = list()
+		delta_map = dict() # anchor -> shift of the addresses from the previous build
+		for name, path, ptype, key in leaf_lst :
+			if key is not None and first_map[key] != name :
+				old = old_map[name]
+				self.addr.append([ name, self.ctype_map[ptype], old[2] + delta_map[key] ] + old[3:])
+				continue
+			addr = next(addr_itr)
+			shape = [int(i) for i in index_rec.findall(path)]
+			if shape :
+				stride = [(next(addr_itr) - addr) for n in shape]
+				self.addr.append([ name, self.ctype_map[ptype], addr, ','.join(str(i) for i in stride) ])
+			else :
+				self.addr.append([ name, self.ctype_map[ptype], addr ])
+			if key is not None :
+				delta_map[key] = addr - old_map[name][2]
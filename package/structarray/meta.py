@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import array
 import ast
+import bisect
 import collections
 import math
 import re
 
+import numpy as np
+
 from cc_pathlib import Path
 
 sizeof_map = { # size of types
@@ -35,6 +39,16 @@ ntype_map = { # types numpy
 	'R8' : "float64",
 }
 
+index_rec = re.compile(r'\[(?P<array>\d+)\]|@(?P<typedef>\d+)') # m[i] for an array member, m@i for a typedef'd array
+
+def array_shape(name) :
+	""" the sizes found in the name of an array, or the indices in the name of an element """
+	return tuple(int(index_res.group('array') or index_res.group('typedef')) for index_res in index_rec.finditer(name))
+
+def array_skeleton(name) :
+	""" the name without its sizes or indices, the same for an array and its elements """
+	return index_rec.sub(lambda index_res : '[]' if index_res.group('array') is not None else '@', name)
+
 def compact_name(v_lst) :
 	# validated
 	# remove duplicate parts from the variable names
@@ -68,6 +82,72 @@ def expand_name(r_lst) :
 		p_lst = n_lst
 	return v_lst
 
+def glob_regex(pattern) :
+	""" * matches anything, dots included, ? matches one character, [ and ] are not special """
+	return re.compile(re.escape(pattern).replace('\\*', '.*').replace('\\?', '.'), re.ASCII)
+
+class NameIndex() :
+	""" index of the dotted names of a mapping, sorted for the prefix and glob queries, and as a tree
+	of components for the children of a node. the answers are given in the order of the mapping """
+
+	def __init__(self, name_lst) :
+		self.name_lst = list(name_lst)
+		self.sorted_lst = sorted(range(len(self.name_lst)), key=self.name_lst.__getitem__) # position of the names, in sorted order
+		self.key_lst = [self.name_lst[i] for i in self.sorted_lst]
+		self._tree = None
+
+	def _range(self, prefix) :
+		a = bisect.bisect_left(self.key_lst, prefix)
+		b = bisect.bisect_left(self.key_lst, prefix + '\U0010ffff', lo=a)
+		return a, b
+
+	def prefix(self, prefix) :
+		""" the names which start with prefix """
+		a, b = self._range(prefix)
+		return [self.name_lst[i] for i in sorted(self.sorted_lst[a:b])]
+
+	def subtree(self, node) :
+		""" the name node itself, and the names below it, its members or its elements """
+		if not node :
+			return list(self.name_lst)
+		i_lst = list()
+		for sep in ['', '.', '[', '@'] :
+			a, b = self._range(node + sep)
+			i_lst += [i for i in self.sorted_lst[a:b] if sep or self.name_lst[i] == node]
+		return [self.name_lst[i] for i in sorted(set(i_lst))]
+
+	def glob(self, pattern) :
+		""" the names matching the whole pattern, only the ones starting with the part of the pattern
+		before the first wildcard are tested """
+		prefix = re.split(r'[*?]', pattern, maxsplit=1)[0]
+		if prefix == pattern :
+			return [pattern,] if pattern in self else list()
+		rec = glob_regex(pattern)
+		a, b = self._range(prefix)
+		return [self.name_lst[i] for i in sorted(self.sorted_lst[a:b]) if rec.fullmatch(self.name_lst[i])]
+
+	def children(self, node='') :
+		""" the components found just below node """
+		if self._tree is None :
+			self._tree = dict()
+			for name in self.name_lst :
+				t = self._tree
+				for n in name.split('.') :
+					t = t.setdefault(n, dict())
+		t = self._tree
+		for n in (node.split('.') if node else []) :
+			if n not in t :
+				raise KeyError(node)
+			t = t[n]
+		return list(t)
+
+	def __contains__(self, name) :
+		a = bisect.bisect_left(self.key_lst, name)
+		return a < len(self.key_lst) and self.key_lst[a] == name
+
+	def __len__(self) :
+		return len(self.name_lst)
+
 class MetaGeneric() :
 	""" decrit les adresses d'un blob binaire
 	TODO : tout remettre la dedans, seuls les loader changent suivant le format
@@ -77,22 +157,175 @@ class MetaGeneric() :
 	def __getitem__(self, key) :
 		return self._m[key]
 
+mtype_lst = list(sizeof_map) # the type codes of the columnar MetaReb
+mtype_code = {mtype : i for i, mtype in enumerate(mtype_lst)}
+mtype_size = np.array([sizeof_map[mtype] for mtype in mtype_lst], dtype=np.int64)
+
 class MetaReb(MetaGeneric) :
-	""" un gestionnaire des méta données pour les enregistrements .reb """
+	""" un gestionnaire des méta données pour les enregistrements .reb
+
+	the mapping is kept by columns: the names in a list, with a dict name -> index, the addresses
+	and the type codes (index in mtype_lst) in compact arrays, seen as numpy arrays for the
+	operations on the whole mapping (alignment, type filter, sort by offset...)
+
+	an array is kept as a single entry, named with its sizes, as m[4096] or in.s[2].v, with the
+	address of its first element and a stride, in bytes, for each dimension. the elements, as m[17]
+	or in.s[1].v, are not stored but can be used as any other variable, their address is computed
+	"""
 	
 	def __init__(self, name=None, sizeof=None) :
-		self._m = collections.OrderedDict()
+		self.clear()
 
 		self.name = name
 		self.sizeof = sizeof
 
-	def push(self, name, mtype, addr) :
-		self._m[name] = (mtype, addr)
+	def clear(self) :
+		self.name_lst = list()
+		self.index_map = dict() # name -> index
+		self._addr = array.array('q')
+		self._code = bytearray()
+		self._column = None # numpy copies of the columns, made on demand
+
+		self.array_map = dict() # name -> stride, for the arrays
+		self.skeleton_map = dict() # skeleton -> name, to find the array of an element
+		self._index = None # NameIndex, built on the first query
+
+	def push(self, name, mtype, addr, stride=None) :
+		if mtype not in mtype_code :
+			raise ValueError(f"unknown type {mtype} for {name}")
+		self._index = None
+		self._column = None
+		if name in self.index_map :
+			i = self.index_map[name]
+			self._addr[i], self._code[i] = addr, mtype_code[mtype]
+		else :
+			self.index_map[name] = len(self.name_lst)
+			self.name_lst.append(name)
+			self._addr.append(addr)
+			self._code.append(mtype_code[mtype])
+		if stride is not None :
+			stride = tuple(int(i) for i in (stride.split(',') if isinstance(stride, str) else stride))
+			if len(stride) != len(array_shape(name)) :
+				raise ValueError(f"{name} has {len(array_shape(name))} dimensions but {len(stride)} strides")
+			self.array_map[name] = stride
+			self.skeleton_map[array_skeleton(name)] = name
+
+	def get_column(self) :
+		""" addr, code and size of the entries, as numpy arrays """
+		if self._column is None :
+			addr = np.array(self._addr, dtype=np.int64)
+			code = np.frombuffer(bytes(self._code), dtype=np.uint8)
+			self._column = addr, code, mtype_size[code]
+		return self._column
+
+	def items(self) :
+		""" name, (mtype, addr) of each entry, arrays included as a single entry """
+		for name, addr, code in zip(self.name_lst, self._addr, self._code) :
+			yield name, (mtype_lst[code], addr)
+
+	def entry_nbr(self) :
+		""" the number of entries, an array being a single one, see items() """
+		return len(self.name_lst)
+
+	def __len__(self) :
+		""" the number of variables given by __iter__, the elements of the arrays but not the pointers """
+		addr, code, size = self.get_column()
+		is_value = np.array([not m.startswith('P') for m in mtype_lst])[code]
+		n = int(is_value.sum())
+		for name in self.array_map :
+			if is_value[self.index_map[name]] :
+				n += math.prod(array_shape(name)) - 1
+		return n
+
+	def __getitem__(self, key) :
+		if key in self.index_map :
+			i = self.index_map[key]
+			return mtype_lst[self._code[i]], self._addr[i]
+		name = self.skeleton_map.get(array_skeleton(key))
+		if name is None :
+			raise KeyError(key)
+		index = array_shape(key)
+		if not all(0 <= i < n for i, n in zip(index, array_shape(name))) :
+			raise KeyError(key)
+		mtype, addr = self[name]
+		return mtype, addr + sum(i * s for i, s in zip(index, self.array_map[name]))
+
+	def __contains__(self, key) :
+		try :
+			self[key]
+			return True
+		except KeyError :
+			return False
 
 	def __iter__(self) :
-		for name, (mtype, addr) in self._m.items() :
-			if not mtype.startswith('P') :
+		""" the names of the variables, the arrays are given element by element """
+		p_set = set(mtype_code[mtype] for mtype in mtype_lst if mtype.startswith('P'))
+		for name, code in zip(self.name_lst, self._code) :
+			if code in p_set :
+				continue
+			if name in self.array_map :
+				yield from self.iter_element(name)
+			else :
 				yield name
+
+	def is_array(self, name) :
+		return name in self.array_map
+
+	def get_array(self, name) :
+		""" mtype, address of the first element, shape and stride of an array """
+		mtype, addr = self[name]
+		return mtype, addr, array_shape(name), self.array_map[name]
+
+	def iter_element(self, name) :
+		part_lst = index_rec.split(name)
+		# split() gives the text between the indices, then the 2 groups of each index
+		text_lst, kind_lst = part_lst[::3], [('[{}]' if a is not None else '@{}') for a in part_lst[1::3]]
+		for index in np.ndindex(* array_shape(name)) :
+			yield ''.join(t + k.format(i) for t, k, i in zip(text_lst, kind_lst, index)) + text_lst[-1]
+
+	def get_extent(self, name=None) :
+		""" number of bytes from the first byte to the last byte of a variable, or of an array.
+		without name, the extents of all the entries, as a numpy array """
+		if name is None :
+			addr, code, size = self.get_column()
+			extent = size.copy()
+			for name in self.array_map :
+				extent[self.index_map[name]] = self.get_extent(name)
+			return extent
+		mtype, addr = self[name]
+		if name not in self.array_map :
+			return sizeof_map[mtype]
+		return sizeof_map[mtype] + sum((n - 1) * s for n, s in zip(array_shape(name), self.array_map[name]) if n)
+
+	def is_contiguous(self, name) :
+		""" True if the elements of the array follow each other, in C order """
+		mtype, addr, shape, stride = self.get_array(name)
+		expected = sizeof_map[mtype]
+		for n, s in reversed(list(zip(shape, stride))) :
+			if n != 1 and s != expected :
+				return False
+			expected *= n
+		return True
+
+	def get_aligned(self) :
+		""" a boolean array, True for the entries aligned on their size, the strides of the arrays included """
+		addr, code, size = self.get_column()
+		aligned = addr % size == 0
+		for name, stride in self.array_map.items() :
+			i = self.index_map[name]
+			aligned[i] &= all(s % size[i] == 0 for s in stride)
+		return aligned
+
+	def filter_type(self, * mtype_lst) :
+		""" the entries of the types given, as 'R8', or as 'R' for all the sizes """
+		addr, code, size = self.get_column()
+		code_lst = [mtype_code[m] for m in mtype_code if any(m.startswith(t) for t in mtype_lst)]
+		return [self.name_lst[i] for i in np.flatnonzero(np.isin(code, code_lst))]
+
+	def sort_by_offset(self) :
+		""" the entries sorted by address, the order of the mapping is kept for equal addresses """
+		addr, code, size = self.get_column()
+		return [self.name_lst[i] for i in np.argsort(addr, kind='stable')]
 		
 	def load(self, pth) :
 		pth = Path(pth).resolve()
@@ -102,7 +335,7 @@ class MetaReb(MetaGeneric) :
 		if not pth.is_file() :
 			raise FileNotFoundError(f"{pth} does not exists")
 		
-		self._m = collections.OrderedDict()
+		self.clear()
 
 		obj = pth.load()
 		
@@ -113,17 +346,25 @@ class MetaReb(MetaGeneric) :
 
 		return self
 
-	def _load_addr(self, obj) :
-		""" si la première ligne des addresses ne contient que 2 champs,
-		on considère que c'est un fichier décrit en relatif """
-		is_relative = len(obj[0]) == 2
+	def _load_addr(self, obj, is_relative=None) :
+		""" si une ligne des addresses ne contient que 2 champs,
+		on considère que c'est un fichier décrit en relatif.
+		sinon, il l'est si les variables mises bout à bout finissent exactement à sizeof.
+		a 4th field gives the strides of an array, separated by commas """
+		if is_relative is None :
+			is_relative = any(len(line) == 2 for line in obj) or self._is_relative(obj)
+
+		self.clear()
 
 		addr = 0
 		for line in obj :
+			stride = None
 			if len(line) == 2 :
 				name, mtype, value = * line, 0
 			elif len(line) == 3 :
 				name, mtype, value = line[0], line[1], int(line[2])
+			elif len(line) == 4 :
+				name, mtype, value, stride = line[0], line[1], int(line[2]), str(line[3])
 			else :
 				raise ValueError(f"malformed line, {line}")
 			
@@ -138,12 +379,29 @@ class MetaReb(MetaGeneric) :
 					raise ValueError
 
 			addr = addr if is_relative else value
-			self._m[name] = (mtype, addr)
+			self.push(name, mtype, addr, stride)
 
-			addr += value + sizeof_map[mtype]
+			addr += value + self.get_extent(name)
 
 			prev = name
 
+		return addr
+
+	def _is_relative(self, obj) :
+		""" True if the variables put end to end, with the paddings of obj, finish exactly at sizeof.
+		nothing is stored, and absolute addresses soon go beyond sizeof """
+		exp = expand_name_gen()
+		next(exp)
+		addr = 0
+		for line in obj :
+			name = exp.send(line[0])
+			addr += (int(line[2]) if 2 < len(line) else 0) + sizeof_map[line[1]]
+			if len(line) == 4 :
+				addr += sum((n - 1) * int(s) for n, s in zip(array_shape(name), str(line[3]).split(',')) if n)
+			if self.sizeof < addr :
+				return False
+		return addr == self.sizeof
+
 	def dump(self, pth, is_relative=True, is_compact=False) :
 		pth = Path(pth).resolve()
 
@@ -161,61 +419,78 @@ class MetaReb(MetaGeneric) :
 
 	def _dump_addr(self, is_relative, is_compact) :
 
-		s_lst = list()
-		p_lst = list()
-
-		prev = 0
-		for name, (mtype, addr) in self._m.items() :
-			if is_compact :
-				n_lst = name.split('.')
-				q = 0
-				for p, n in zip(p_lst, n_lst) :
-					if p != n :
-						break
-					q += 1
-				name = (f"{q}/" if q else '') + '.'.join(n_lst[q:])
-				p_lst = n_lst
-			if is_relative :
-				element_nbr = int(re.match(r'.*?\[(?P<size>\d+)\]', name).group('size')) if name.endswith(']') else 1
-
-				if s_lst :
-					padding = addr - prev
-					# assert 0 <= padding < 7
-					if padding != 0 :
-						s_lst[-1].append(padding)
-
-				s_lst.append([name, mtype,])
-
-				element_size = int(s_lst[-1][1][1:])
-				prev = addr + (element_size * element_nbr)
-			else :
-				s_lst.append([name, mtype, addr])
+		name_lst = compact_name(self.name_lst) if is_compact else self.name_lst
+		addr, code, size = self.get_column()
 
 		if is_relative :
-			padding = self.sizeof - prev
-			if padding != 0 :
-				s_lst[-1].append(padding)
+			# the padding after each variable, up to the next one, or to sizeof for the last
+			end = addr + self.get_extent()
+			value_lst = (np.append(addr[1:], self.sizeof) - end).tolist()
+		else :
+			value_lst = addr.tolist()
+
+		s_lst = list()
+		for key, name, c, value in zip(self.name_lst, name_lst, code.tolist(), value_lst) :
+			line = [name, mtype_lst[c], value]
+			if key in self.array_map :
+				line.append(','.join(str(i) for i in self.array_map[key]))
+			elif is_relative and value == 0 :
+				line.pop()
+			s_lst.append(line)
 
 		return s_lst
 		
 	def __eq__(self, other) :
-		for self_line, other_line  in zip(self._m.items(), other._m.items()) :
+		for self_line, other_line  in zip(self.items(), other.items()) :
 			if self_line != other_line :
 				print("SELF ", self_line)
 				print("OTHER", other_line)
 				return False
-		return True
+		return self.array_map == other.array_map
 	
+	def get_dtype(self, * name_lst) :
+		""" return a structured numpy dtype which describes one record, restricted to the
+		variables of name_lst if given. offsets are explicit, unaligned fields are allowed.
+		a contiguous array is a single field of its shape """
+		if not name_lst and not self.array_map :
+			# all the variables, straight from the columns
+			addr, code, size = self.get_column()
+			is_value = np.array([not m.startswith('P') for m in mtype_lst])[code]
+			return np.dtype({
+				'names' : [name for name, v in zip(self.name_lst, is_value.tolist()) if v],
+				'formats' : [ntype_map[mtype_lst[c]] for c in code[is_value].tolist()],
+				'offsets' : addr[is_value].tolist(),
+				'itemsize' : self.sizeof,
+			})
+		if not name_lst :
+			name_lst = list(self)
+		format_lst = list()
+		for name in name_lst :
+			mtype, addr = self[name]
+			if name in self.array_map :
+				if not self.is_contiguous(name) :
+					raise ValueError(f"{name} is not contiguous and can not be described by a dtype, read it alone")
+				format_lst.append((ntype_map[mtype], array_shape(name)))
+			else :
+				format_lst.append(ntype_map[mtype])
+		return np.dtype({
+			'names' : list(name_lst),
+			'formats' : format_lst,
+			'offsets' : [self[name][1] for name in name_lst],
+			'itemsize' : self.sizeof,
+		})
+
 	def is_aligned(self, name) :
 		ctype, offset = self[name]
-		return offset % sizeof_map[ctype] == 0
+		return offset % sizeof_map[ctype] == 0 and all(s % sizeof_map[ctype] == 0 for s in self.array_map.get(name, ()))
 
 	def all_aligned(self) :
-		for name in self._m :
-			ctype, offset = self._m[name]
-			if offset % sizeof_map[ctype] != 0 :
-				print(f"{name} is not aligned: size={sizeof_map[ctype]} offeset={offset}")
-				return False
+		aligned = self.get_aligned()
+		if not aligned.all() :
+			name = self.name_lst[np.argmin(aligned)]
+			ctype, offset = self[name]
+			print(f"{name} is not aligned: size={sizeof_map[ctype]} offeset={offset}")
+			return False
 		return True
 	
 	def search(self, pattern, mode='blob') :
@@ -227,6 +502,23 @@ class MetaReb(MetaGeneric) :
 		rec = re.compile(pattern, re.IGNORECASE | re.ASCII)
 		return [var for var in self if rec.search(var) is not None]
 
+	def get_index(self) :
+		if self._index is None :
+			self._index = NameIndex(self)
+		return self._index
+
+	def prefix(self, prefix) :
+		return self.get_index().prefix(prefix)
+
+	def glob(self, pattern) :
+		return self.get_index().glob(pattern)
+
+	def subtree(self, node) :
+		return self.get_index().subtree(node)
+
+	def children(self, node='') :
+		return self.get_index().children(node)
+
 
 def expand_name_gen() :
 	# validated
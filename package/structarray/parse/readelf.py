@@ -1,6 +1,217 @@
+#!/usr/bin/env python3
 
+"""
+build the mapping of a variable from the DWARF debug info of the elf, as dumped by
+`readelf --debug-dump=info`. the offsets are computed from the member locations and the
+array strides, no gdb is involved.
 
+the names and types are the ones MetaParser would give:
+- members are joined by '.', pointers are P types and enums are Z types
+- an array member is m[n], a typedef'd array is m@n, with the strides of its dimensions
+"""
+
+import math
+import re
+import subprocess
+import sys
+
+from cc_pathlib import Path
+
+die_rec = re.compile(r'''^\s*<(?P<depth>\d+)><(?P<offset>[0-9a-f]+)>: Abbrev Number: (?P<abbrev>\d+)(\s*\((?P<tag>DW_TAG_\w+)\))?''')
+attr_rec = re.compile(r'''^\s*<[0-9a-f]+>\s+DW_AT_(?P<attr>\w+)\s*:\s*(?P<value>.*)$''')
+form_rec = re.compile(r'''^\((\w+)\)\s*''') # dwarf form, as (data1), (strp)...
+indirect_rec = re.compile(r'''^\([^)]*\):\s*''') # (indirect string, offset: 0x8e): ...
+ref_rec = re.compile(r'''<0x(?P<ref>[0-9a-f]+)>''')
+uconst_rec = re.compile(r'''DW_OP_plus_uconst:\s*(?P<value>\d+)''')
+
+keep_tag_set = {
+	'base_type', 'typedef', 'const_type', 'volatile_type', 'restrict_type', 'atomic_type',
+	'pointer_type', 'reference_type', 'rvalue_reference_type', 'ptr_to_member_type',
+	'structure_type', 'class_type', 'union_type', 'array_type', 'subrange_type', 'enumeration_type',
+	'member', 'variable',
+}
+
+ref_attr_set = {'type', 'specification', 'abstract_origin'}
+int_attr_set = {'byte_size', 'encoding', 'data_member_location', 'upper_bound', 'lower_bound', 'count', 'byte_stride', 'bit_size', 'data_bit_offset'}
+flag_attr_set = {'declaration',}
+
+qualifier_set = {'typedef', 'const_type', 'volatile_type', 'restrict_type', 'atomic_type'}
+pointer_set = {'pointer_type', 'reference_type', 'rvalue_reference_type', 'ptr_to_member_type'}
+
+def parse_value(attr, value) :
+	value = form_rec.sub('', value, count=1)
+	if attr in ref_attr_set :
+		return int(ref_rec.search(value).group('ref'), 16)
+	elif attr in int_attr_set :
+		if (ref_res := ref_rec.match(value)) is not None :
+			return None # dynamic, as the bound of a variable length array
+		if (uconst_res := uconst_rec.search(value)) is not None :
+			return int(uconst_res.group('value'))
+		return int(value.split()[0], 0)
+	elif attr in flag_attr_set :
+		return True
+	else :
+		return indirect_rec.sub('', value, count=1).strip()
 
 class ParserReadELF() :
-	def __init__(self, obj_pth) :
+	def __init__(self, elf_pth) :
 		self.elf_pth = elf_pth.resolve()
+
+		self.die_map = dict() # offset -> (tag, attr_map, child_lst)
+		self.addr = list()
+
+	def read(self, dump_pth=None) :
+		""" parse the output of readelf, either run on the elf or previously saved in dump_pth """
+		if dump_pth is None :
+			proc = subprocess.Popen(['readelf', '--debug-dump=info', '--wide', str(self.elf_pth)], stdout=subprocess.PIPE, text=True, errors='replace')
+			self._read(proc.stdout)
+			if proc.wait() != 0 :
+				raise ValueError(f"readelf failed on {self.elf_pth}")
+		else :
+			with Path(dump_pth).open('rt', errors='replace') as fid :
+				self._read(fid)
+		return self
+
+	def _read(self, line_iter) :
+		self.die_map = dict()
+
+		parent_lst = list() # the offset of the last die seen at each depth
+		attr_map = None
+		for line in line_iter :
+			if (die_res := die_rec.match(line)) is not None :
+				attr_map = None
+				tag = die_res.group('tag')
+				if tag is None :
+					continue # null entry, the end of a list of children
+				depth, offset = int(die_res.group('depth')), int(die_res.group('offset'), 16)
+				del parent_lst[depth:]
+				parent_lst.append(offset)
+				tag = tag[7:]
+				if tag not in keep_tag_set :
+					continue
+				attr_map = dict()
+				self.die_map[offset] = (tag, attr_map, list())
+				if 0 < depth and parent_lst[depth-1] in self.die_map :
+					self.die_map[parent_lst[depth-1]][2].append(offset)
+			elif attr_map is not None and (attr_res := attr_rec.match(line)) is not None :
+				attr = attr_res.group('attr')
+				if attr in ref_attr_set or attr in int_attr_set or attr in flag_attr_set or attr == 'name' :
+					attr_map[attr] = parse_value(attr, attr_res.group('value'))
+
+	def find_variable(self, var_name) :
+		""" return the offset of the type of the variable """
+		for offset, (tag, attr_map, child_lst) in self.die_map.items() :
+			if tag == 'variable' and attr_map.get('name') == var_name :
+				if 'type' in attr_map :
+					return attr_map['type']
+				for key in ['specification', 'abstract_origin'] :
+					if key in attr_map and 'type' in self.die_map[attr_map[key]][1] :
+						return self.die_map[attr_map[key]][1]['type']
+		raise ValueError(f"this var is not known: {var_name}")
+
+	def get_sizeof(self, offset) :
+		tag, attr_map, child_lst = self.die_map[offset]
+		if 'byte_size' in attr_map :
+			return attr_map['byte_size']
+		if tag in qualifier_set :
+			return self.get_sizeof(attr_map['type'])
+		if tag == 'array_type' :
+			return self.get_stride(offset) * math.prod(self.get_shape(offset))
+		raise ValueError(f"unknown size for the type at <0x{offset:x}>")
+
+	def get_shape(self, offset) :
+		shape = list()
+		for c in self.die_map[offset][2] :
+			tag, attr_map, null = self.die_map[c]
+			if tag != 'subrange_type' :
+				continue
+			if 'count' in attr_map :
+				n = attr_map['count']
+			elif attr_map.get('upper_bound') is not None :
+				n = attr_map['upper_bound'] - attr_map.get('lower_bound', 0) + 1
+			else :
+				n = 0 # flexible array member
+			shape.append(n if n is not None and 0 <= n < 2**62 else 0)
+		return shape
+
+	def get_stride(self, offset) :
+		""" the size of the elements of the array """
+		tag, attr_map, child_lst = self.die_map[offset]
+		return attr_map.get('byte_stride') or self.get_sizeof(attr_map['type'])
+
+	def get_mtype(self, offset) :
+		tag, attr_map, child_lst = self.die_map[offset]
+		size = self.get_sizeof(offset)
+		if tag in pointer_set :
+			return f'P{size}'
+		name = attr_map.get('name', '')
+		if tag == 'base_type' and name in ['float', 'double'] :
+			return f'R{size}'
+		elif tag == 'base_type' and 'unsigned' in name :
+			return f'N{size}'
+		return f'Z{size}'
+
+	def walk(self, offset, name='', addr=0, typedef=False, stride=()) :
+		""" yield name, mtype, addr, stride for each scalar found below the type at offset.
+		arrays are not expanded, their sizes are kept in the name and stride gives, for each
+		dimension, the distance in bytes between two elements. stride is None for a scalar """
+		tag, attr_map, child_lst = self.die_map[offset]
+
+		if tag in qualifier_set :
+			yield from self.walk(attr_map['type'], name, addr, typedef or tag == 'typedef', stride)
+		elif tag in ['structure_type', 'class_type', 'union_type'] :
+			for c in child_lst :
+				m_tag, m_attr, null = self.die_map[c]
+				if m_tag != 'member' or 'bit_size' in m_attr or 'type' not in m_attr :
+					continue # bit fields have no address
+				m_name = m_attr.get('name')
+				m_name = name if m_name is None else (f'{name}.{m_name}' if name else m_name) # anonymous members are merged in their parent
+				yield from self.walk(m_attr['type'], m_name, addr + (m_attr.get('data_member_location') or 0), False, stride)
+		elif tag == 'array_type' :
+			shape = self.get_shape(offset)
+			element = self.get_stride(offset)
+			name += ''.join((f'@{n}' if typedef else f'[{n}]') for n in shape)
+			stride += tuple(element * math.prod(shape[k+1:]) for k in range(len(shape)))
+			yield from self.walk(attr_map['type'], name, addr, False, stride)
+		else :
+			yield name, self.get_mtype(offset), addr, (stride if stride else None)
+
+	def parse(self, var_name) :
+		if not self.die_map :
+			self.read()
+
+		offset = self.find_variable(var_name)
+
+		self.var_name = var_name
+		self.var_type = self.die_map[offset][1].get('name', var_name)
+		self.var_size = self.get_sizeof(offset)
+
+		self.addr = [
+			[name, mtype, addr] if stride is None else [name, mtype, addr, ','.join(str(i) for i in stride)]
+			for name, mtype, addr, stride in self.walk(offset)
+		]
+
+		print(f"sizeof({self.var_type}) = {self.var_size}")
+
+		return self.var_size
+
+	def get_meta(self) :
+		from structarray.meta import MetaReb
+		u = MetaReb(self.var_name, self.var_size)
+		for line in self.addr :
+			u.push(* line)
+		return u
+
+	def save(self, pth) :
+		u = self.get_meta()
+		u.dump(pth.with_suffix('.map.tsv'), True, True)
+		u.dump(pth.with_suffix('.abs.tsv'))
+
+	def print(self) :
+		for line in ([[self.var_type, self.var_size],] + self.addr) :
+			print('\t'.join([str(i) for i in line]))
+
+if __name__ == '__main__' :
+	u = ParserReadELF(Path(sys.argv[1]))
+	u.parse(sys.argv[2])
+	u.save(Path(sys.argv[3]) if 3 < len(sys.argv) else Path(sys.argv[2]))
@@ -1,44 +1,83 @@
 #!/usr/bin/env python3
 
-import collections
+import concurrent.futures
 import hashlib
 import io
 import math
 import os
-import re
-import struct
+import tempfile
+import threading
+import time
 
 import numpy as np
+import numpy.lib.recfunctions as rfn
 
 from cc_pathlib import Path
 
-from structarray.meta import MetaReb, sizeof_map, ntype_map, compact_name
-
-stype_map = { # types of struct
-	'Z1' : "b",
-	'Z2' : "h",
-	'Z4' : "i",
-	'Z8' : "q",
-	'N1' : "B",
-	'N2' : "H",
-	'N4' : "I",
-	'N8' : "Q",
-	'R4' : "f",
-	'R8' : "d",
-}
-
-def glob_to_regex(s) :
-	s = re.escape(s)
-	s = s.replace('\\*', '.*?')
-	return '(' + s + ')'
+from structarray.meta import MetaReb, sizeof_map, ntype_map
+
+def _extract_worker(data_pth, sizeof, array_len, dtype, out_pth, out_len, layout_lst, start, stop, step, j, chunk_size) :
+	""" worker side of RebHandler.get_parallel(), map the file and copy the records start:stop:step
+	of each variable in its column of the shared output file, starting at the index j """
+	record = np.memmap(data_pth, dtype=np.uint8, mode='r', shape=(array_len * sizeof,)).view(dtype)
+	out = np.memmap(out_pth, dtype=np.uint8, mode='r+')
+	out_map = {name : out[offset:offset + out_len * ftype.itemsize].view(ftype.base).reshape((out_len,) + ftype.shape) for name, ftype, offset in layout_lst}
+
+	chunk_len = max(1, chunk_size // (sizeof * step)) * step # copied by chunks, to stay in the page cache
+	for i in range(start, stop, chunk_len) :
+		rec = record[i:min(i + chunk_len, stop):step]
+		for name in out_map :
+			out_map[name][j:j+len(rec)] = rec[name]
+		j += len(rec)
+
+	out.flush()
+
+class Prefetch() :
+	""" handle on a background prefetch, see RebHandler.prefetch() """
+
+	def __init__(self, name_lst, array_len) :
+		self.name_lst = name_lst
+		self.array_len = array_len
+		self.done = 0 # number of records read
+
+		self.thread = None
+		self.error = None
+		self._cancel = threading.Event()
+
+	def progress(self) :
+		if not self.name_lst :
+			return 1.0
+		return self.done / self.array_len if self.array_len else 1.0
+
+	def cancel(self) :
+		self._cancel.set()
+
+	def is_cancelled(self) :
+		return self._cancel.is_set()
+
+	def is_running(self) :
+		return self.thread is not None and self.thread.is_alive()
+
+	def wait(self, timeout=None) :
+		""" wait for the end of the prefetch, raise the error of the thread if any """
+		if self.thread is not None :
+			self.thread.join(timeout)
+		if self.error is not None :
+			raise self.error
+		return not self.is_running()
 
 class RebHandler() :
 
+	huge_file_size = 2**32 # above 4 GiBytes, the columns read are kept in a cache
+	chunk_size = 2**26 # number of bytes read at once when the file is scanned sequentially
+
 	def __init__(self, cache_disabled=False) :
 		self.meta = MetaReb()
 		self.data = None
 
+		self.cache = None
 		self.cache_disabled = cache_disabled
+		self._lock = threading.RLock() # the cache can be filled by a prefetch thread
 
 		self.array_len = 0
 		
@@ -46,6 +85,9 @@ class RebHandler() :
 		self.extract_map = dict()
 		self.extract_lst = list()
 
+		self._grow_map = dict() # name -> buffer behind the columns of extract_map, in follow mode
+		self._window_map = dict() # name -> (start, stop), the records held by the columns of extract_map
+
 	def __len__(self) :
 		return self.array_len
 	
@@ -65,75 +107,347 @@ class RebHandler() :
 		if self.end_of_file :
 			print(f"! possible incomplete block at the end of data, file will be truncated at {self.end_of_file}")
 
-		if 2**32 <= self.data_len :
-			self.data = self.data_pth # direct file access mode for files of more than 4 GiBytes
-			if not self.cache_disabled :
-				try :
-					from structarray.cache import CacheHandler
-					self.cache = CacheHandler(self.data_pth.with_suffix('.__cache__.hdf5'))
-				except ModuleNotFoundError :
-					self.cache = dict()
-				print("! huge file detected, cache activated")
+		self.data = self._map_data()
+
+		if self.huge_file_size <= self.data_len and not self.cache_disabled :
+			from structarray.cache import CacheHandler, MemoryCache
+			try :
+				self.cache = CacheHandler(self.data_pth.with_suffix('.__cache__.hdf5'), self.get_signature())
+			except (ModuleNotFoundError, OSError) as exc :
+				print(f"! {exc}\n! the cache is kept in memory only")
+				self.cache = MemoryCache()
+			print("! huge file detected, cache activated")
 		else :
-			self.data = self.data_pth.read_bytes()[:self.end_of_file]
 			self.cache_disabled = True
 
 		return self
 
-	def get_from_file(self, name) :
-		ctype, offset = self.meta[name]
+	def close(self) :
+		""" release the cache, the mapped file stays readable """
+		if self.cache is not None :
+			self.cache.close()
+		self.cache_disabled = True
 
-		v_len = struct.calcsize(stype_map[ctype])
-		v_lst = list()
-		pos = offset
-		with self.data.open('rb') as fid :
-			while pos <= self.data_len :
-				fid.seek(pos)
-				v = struct.unpack(stype_map[ctype], fid.read(v_len))[0]
-				v_lst.append(v)
-				pos += self.meta.sizeof
-
-		return np.array(v_lst)
-	
-	def get_from_buffer(self, name) :
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) :
+		self.close()
+
+	def get_signature(self) :
+		""" identify the recording (size and date of the .reb) and its mapping (digest of the .tsv),
+		a cache built for another signature is out of date """
+		st = self.data_pth.stat()
+		meta_hsh = hashlib.blake2b(self.meta_pth.read_bytes(), digest_size=16).hexdigest()
+		return f"{st.st_size}:{st.st_mtime_ns}:{meta_hsh}"
+
+	def _map_data(self) :
+		""" map the complete blocks of the file as a (array_len, sizeof) matrix of bytes,
+		nothing is read until a column is accessed, whatever the size of the file """
+		if self.array_len == 0 :
+			return np.zeros((0, self.meta.sizeof), dtype=np.uint8)
+		return np.memmap(self.data_pth, dtype=np.uint8, mode='r', shape=(self.array_len, self.meta.sizeof))
+
+	def refresh(self) :
+		""" look for complete blocks appended to the file since the last call, map them and extend
+		the columns of extract_map which went up to the previous end of the file (the ones extracted
+		on a window which stops before are kept as they are). return the range of the new records,
+		empty if none """
+		data_len = self.data_pth.stat().st_size
+		array_len = data_len // self.meta.sizeof
+
+		prev_len = self.array_len
+		if array_len <= prev_len :
+			return range(prev_len, prev_len)
+
+		self.data_len = data_len
+		self.array_len = array_len
+		self.end_of_file = self.array_len * self.meta.sizeof if ( self.data_len % self.meta.sizeof != 0 ) else None
+
+		self.data = self._map_data()
+
+		if not self.cache_disabled :
+			print("! the file is growing, cache deactivated")
+			self.cache_disabled = True
+
+		grow_lst = [k for k in self.extract_map if self._window_map.get(k, (0, prev_len))[1] == prev_len]
+		if grow_lst :
+			rec = self[grow_lst, prev_len:array_len]
+			for k in grow_lst :
+				col = self.extract_map[k]
+				# the columns grow in buffers of doubling capacity, not by a copy at each refresh
+				buf = self._grow_map.get(k)
+				if buf is None or len(buf) < len(col) + len(rec) :
+					buf = np.empty((max(2 * len(col), len(col) + len(rec)),), dtype=col.dtype)
+					buf[:len(col)] = col
+					self._grow_map[k] = buf
+				buf[len(col):len(col) + len(rec)] = rec[k]
+				self.extract_map[k] = buf[:len(col) + len(rec)]
+				self._window_map[k] = (self._window_map.get(k, (0, prev_len))[0], array_len)
+
+		return range(prev_len, array_len)
+
+	def follow(self, period=1.0, timeout=None) :
+		""" watch the file while it is being written, yield the range and the records appended since
+		the last check (a structured array of the variables of extract_lst, or of all of them).
+		stop when no new record came during timeout seconds, if given """
+		last = time.monotonic()
+		while True :
+			new_range = self.refresh()
+			if new_range :
+				yield new_range, self[self.extract_lst or list(self.meta), new_range.start:new_range.stop]
+				last = time.monotonic()
+			elif timeout is not None and timeout <= time.monotonic() - last :
+				return
+			else :
+				time.sleep(period)
+
+	def watch(self, callback, period=1.0, timeout=None) :
+		""" same as follow(), each batch of new records is given to callback(new_range, rec) """
+		for new_range, rec in self.follow(period, timeout) :
+			callback(new_range, rec)
+
+	def get_from_buffer(self, name, s=slice(None)) :
 		# print(f"get_from_buffer({name})")
+		if self.meta.is_array(name) :
+			return self.get_array(name, s)
+
 		ctype, offset = self.meta[name]
-		width = self.data_len // self.meta.sizeof
-		height = self.data_len // ( width * sizeof_map[ctype] )
+
+		column = self.data[s,offset:offset + sizeof_map[ctype]] # strided view on the bytes of the variable, only the records of s
 
 		if self.meta.is_aligned(name) :
-			arr = np.frombuffer(self.data, dtype=ntype_map[ctype])
-			arr.shape = (width, height)
-			return arr[:,int(offset) // sizeof_map[ctype]]
+			# strided view on the mapped file, nothing is copied
+			return column.view(ntype_map[ctype])[:,0]
 		else :
-			v_lst = list()
-			pos = offset
-			for i in range(width) :
-				v = struct.unpack_from(stype_map[ctype], self.data, pos)[0]
-				v_lst.append(v)
-				pos += self.meta.sizeof
-			return np.array(v_lst)
-
-	def __getitem__(self, name) :
-		# print(f"__getitem__({name})")
-		if isinstance(self.data, Path) :
-			if self.cache_disabled or name not in self.cache :
-				v_arr = self.get_from_file(name)
-				if not self.cache_disabled :
-					self.cache[name] = v_arr
-			else :
-				v_arr = self.cache[name]
-			return v_arr
+			# reinterpreted as an unaligned strided view, then copied in an aligned buffer
+			return column.view(ntype_map[ctype])[:,0].copy()
+
+	def get_array(self, name, s=slice(None)) :
+		""" an array of the mapping, as a (records, * shape) strided view on the mapped file,
+		the elements are never copied one by one, whatever the size of the array """
+		ctype, offset, shape, stride = self.meta.get_array(name)
+		start, stop, step = s.indices(self.array_len)
+		n = len(range(start, stop, step))
+		if n == 0 :
+			return np.zeros((0,) + shape, dtype=ntype_map[ctype])
+
+		arr = np.ndarray((n,) + shape, dtype=ntype_map[ctype], buffer=self.data,
+			offset=start * self.meta.sizeof + offset, strides=(step * self.meta.sizeof,) + stride)
+
+		if self.meta.is_aligned(name) :
+			return arr
 		else :
-			return self.get_from_buffer(name)
+			return arr.copy() # in an aligned buffer
+
+	def get_from_record(self, name_lst, start=None, stop=None, step=None) :
+		""" extract all the variables of name_lst in a single pass over the records selected,
+		return a packed structured array, one field per variable (contiguous arrays included) """
+		name_lst = list(name_lst)
+		if not name_lst :
+			return np.zeros((len(range(* slice(start, stop, step).indices(self.array_len))),), dtype=[])
+		dtype, ftype_map = self._get_layout(name_lst)
+		record = self.data.reshape(-1).view(dtype)[start:stop:step] # only the selected records will be read
+		if len(dtype.fields) == len(ftype_map) :
+			return rfn.repack_fields(record, align=True)
+		# the arrays which are not contiguous are not fields of the records, they are copied in the result
+		res = np.empty((len(record),), dtype=np.dtype(list(ftype_map.items()), align=True))
+		for name in ftype_map :
+			res[name] = record[name] if name in dtype.fields else self.get_array(name, slice(start, stop, step))
+		return res
+
+	def _get_layout(self, name_lst) :
+		""" the dtype of the records, restricted to the variables of name_lst which can be fields of it, and
+		the type of each variable. the arrays which are not contiguous are left out, see get_array() """
+		field_lst = [name for name in name_lst if not self.meta.is_array(name) or self.meta.is_contiguous(name)]
+		dtype = self.meta.get_dtype(* field_lst) if field_lst else np.dtype({'names' : [], 'formats' : [], 'itemsize' : self.meta.sizeof})
+		ftype_map = dict()
+		for name in name_lst :
+			if name in dtype.fields :
+				ftype_map[name] = dtype.fields[name][0]
+			else :
+				ctype, offset, shape, stride = self.meta.get_array(name)
+				ftype_map[name] = np.dtype((ntype_map[ctype], shape))
+		return dtype, ftype_map
+
+	def get_many(self, name_lst, start=None, stop=None, step=None, worker_nbr=None) :
+		""" extract all the variables of name_lst with a single sequential read of the file,
+		by chunks of about chunk_size bytes, return a dict name -> array.
+		if worker_nbr is given, the read is done by get_parallel() """
+		name_lst = list(name_lst)
+		start, stop, step = slice(start, stop, step).indices(self.array_len)
+		if step <= 0 :
+			raise ValueError(f"step must be positive, got {step}")
+		is_complete = (start, stop, step) == (0, self.array_len, 1)
+
+		res_map = dict()
+		if is_complete and not self.cache_disabled :
+			with self._lock :
+				for name in name_lst :
+					if (value := self.cache.get(name)) is not None :
+						res_map[name] = value
+
+		todo_lst = [name for name in name_lst if name not in res_map]
+		if todo_lst and worker_nbr :
+			out_map = self.get_parallel(todo_lst, start, stop, step, worker_nbr)
+		elif todo_lst :
+			dtype, ftype_map = self._get_layout(todo_lst)
+			out_map = {name : np.empty((len(range(start, stop, step)),), dtype=ftype) for name, ftype in ftype_map.items()}
+
+			j = 0
+			for rec in (self._scan(dtype, start, stop, step) if dtype.names else []) :
+				for name in dtype.names :
+					out_map[name][j:j+len(rec)] = rec[name]
+				j += len(rec)
+			for name in todo_lst :
+				if name not in dtype.fields :
+					out_map[name][:] = self.get_array(name, slice(start, stop, step))
+
+		for name in todo_lst :
+			if is_complete and not self.cache_disabled :
+				with self._lock :
+					self.cache[name] = out_map[name]
+			res_map[name] = out_map[name]
+
+		return {name : res_map[name] for name in name_lst}
+
+	def _scan(self, dtype, start, stop, step) :
+		""" read the records start:stop of the file sequentially, by chunks of about chunk_size bytes,
+		yield the records selected by step in each chunk, as a view of dtype on a reused buffer """
+		chunk_len = max(1, self.chunk_size // (self.meta.sizeof * step)) * step # a multiple of step
+		buffer = np.empty((chunk_len * self.meta.sizeof,), dtype=np.uint8)
+
+		with self.data_pth.open('rb') as fid :
+			fid.seek(start * self.meta.sizeof)
+			for i in range(start, stop, chunk_len) :
+				n = min(chunk_len, stop - i) * self.meta.sizeof
+				if fid.readinto(memoryview(buffer)[:n]) != n :
+					raise EOFError(f"{self.data_pth} was truncated while being read")
+				yield buffer[:n].view(dtype)[::step]
+
+	def prefetch(self, pattern_or_names) :
+		""" fill the cache with the variables matching a pattern (see MetaReb.search) or given as a list,
+		in a background thread which reads the file once, sequentially. return a Prefetch handle,
+		to follow the progress or cancel it.
+		each chunk read goes straight to the file of the cache, the columns are not held in memory. when
+		the cache is in memory only, the variables are restricted to the ones which fit in it """
+		name_lst = self.meta.search(pattern_or_names) if isinstance(pattern_or_names, str) else list(pattern_or_names)
+		if self.cache_disabled :
+			name_lst = list() # columns are mapped views, there is nothing to prefetch
+		with self._lock :
+			name_lst = [name for name in name_lst if name not in self.cache]
+
+		writer = None
+		if name_lst :
+			dtype, ftype_map = self._get_layout(name_lst)
+			with self._lock :
+				writer = self.cache.open_writer(name_lst, list(ftype_map.values()), self.array_len)
+			name_lst = writer.key_lst
+
+		task = Prefetch(name_lst, self.array_len)
+		if name_lst :
+			task.thread = threading.Thread(target=self._prefetch, args=(task, writer), daemon=True)
+			task.thread.start()
+		return task
+
+	def _prefetch(self, task, writer) :
+		try :
+			dtype, ftype_map = self._get_layout(task.name_lst)
+			for rec in self._scan(dtype, 0, self.array_len, 1) :
+				if task.is_cancelled() :
+					with self._lock :
+						writer.abort()
+					return
+				s = slice(task.done, task.done + len(rec))
+				chunk = {name : rec[name] if name in dtype.fields else self.get_array(name, s) for name in task.name_lst}
+				with self._lock :
+					writer.write(task.done, chunk)
+				task.done += len(rec)
+			with self._lock :
+				writer.commit()
+		except Exception as exc :
+			task.error = exc
+
+	def get_parallel(self, name_lst, start=None, stop=None, step=None, worker_nbr=None) :
+		""" extract all the variables of name_lst, the records selected are split among worker_nbr
+		processes (one per cpu by default) which map the file on their own. the columns are written
+		in a shared file (in /dev/shm when available) and given back without being pickled """
+		name_lst = list(name_lst)
+		if worker_nbr is None :
+			worker_nbr = os.cpu_count()
+		index = range(* slice(start, stop, step).indices(self.array_len))
+		if index.step <= 0 :
+			raise ValueError(f"step must be positive, got {index.step}")
+		dtype, ftype_map = self._get_layout(name_lst)
+
+		layout_lst = list() # name, dtype, offset of each column in the shared file
+		out_size = 0
+		for name in dtype.names :
+			ftype = dtype.fields[name][0]
+			layout_lst.append((name, ftype, out_size))
+			out_size += -(-len(index) * ftype.itemsize // 8) * 8 # each column starts on a multiple of 8 bytes
+		out_size = max(out_size, 1)
+
+		shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+		with tempfile.NamedTemporaryFile(dir=shm_dir, prefix='structarray.', suffix='.tmp') as fid :
+			fid.truncate(out_size)
+			fid.flush()
+			out = np.memmap(fid.name, dtype=np.uint8, mode='r+', shape=(out_size,))
+			with concurrent.futures.ProcessPoolExecutor(worker_nbr) as pool :
+				job_lst = list()
+				for k in range(worker_nbr) :
+					a, b = len(index) * k // worker_nbr, len(index) * (k + 1) // worker_nbr
+					if a < b :
+						job_lst.append(pool.submit(_extract_worker,
+							self.data_pth, self.meta.sizeof, self.array_len, dtype, fid.name, len(index), layout_lst,
+							index[a], index[b-1] + 1, index.step, a, self.chunk_size
+						))
+				for job in job_lst :
+					job.result()
+		# the shared file is now deleted, but the mapping stays valid as long as the columns are in use
+
+		res_map = {name : out[offset:offset + len(index) * ftype.itemsize].view(ftype.base).reshape((len(index),) + ftype.shape) for name, ftype, offset in layout_lst}
+		for name in name_lst :
+			if name not in res_map :
+				# the arrays which are not contiguous are read by the main process
+				res_map[name] = np.array(self.get_array(name, slice(index.start, index.stop, index.step)))
+		return {name : res_map[name] for name in name_lst}
+
+	def __getitem__(self, key) :
+		""" key can be a name, a list of names, or one of them followed by a slice of records:
+		reb[name], reb[name, start:stop:step], reb[name_lst], reb[name_lst, start:stop:step] """
+		# print(f"__getitem__({key})")
+		name, s = key if isinstance(key, tuple) else (key, slice(None))
+		if not isinstance(s, slice) :
+			raise TypeError(f"records must be selected with a slice, got {s!r}")
+
+		if isinstance(name, list) :
+			return self.get_from_record(name, s.start, s.stop, s.step)
+		if self.cache_disabled :
+			return self.get_from_buffer(name, s)
+		if s != slice(None) :
+			# partial reads are not cached, and a column is taken from the cache only when it is in memory,
+			# reading it from the file of a CacheHandler would cost more than the window
+			with self._lock :
+				value = getattr(self.cache, 'memory', self.cache).get(name)
+			return self.get_from_buffer(name, s) if value is None else value[s]
+		with self._lock :
+			value = self.cache.get(name)
+		if value is not None :
+			return value
+		v_arr = np.array(self.get_from_buffer(name))
+		with self._lock :
+			self.cache[name] = v_arr
+		return v_arr
 
 	def filter_select(self, * filter_lst) :
-		filter_lst = [glob_to_regex(line) for line in filter_lst]
-		filter_rec = re.compile('|'.join(filter_lst))
-
-		for var in self.var_lst :
-			if filter_rec.search(var) :
-				self.extract_lst.append(var)
+		""" add to extract_lst the variables matching one of the glob patterns (see MetaReb.glob) """
+		extract_set = set(self.extract_lst)
+		for pattern in filter_lst :
+			for var in self.meta.glob(pattern) :
+				if var not in extract_set :
+					self.extract_lst.append(var)
+					extract_set.add(var)
 
 	def filter_all(self) :
 		self.extract_lst = list(self.meta)
@@ -141,10 +455,20 @@ class RebHandler() :
 	def filter_reset(self) :
 		self.extract_lst = list()
 		
-	def extract(self, start=None, stop=None) :
-		for k in self.meta :
-			if k not in self.extract_map :
-				self.extract_map[k] = self[k][start:stop]
+	def extract(self, start=None, stop=None, worker_nbr=None) :
+		k_lst = [k for k in self.meta if k not in self.extract_map]
+		if worker_nbr :
+			self.extract_map.update(self.get_many(k_lst, start, stop, worker_nbr=worker_nbr))
+		elif self.cache_disabled :
+			rec = self.get_from_record(k_lst, start, stop)
+			for k in k_lst :
+				self.extract_map[k] = rec[k]
+		else :
+			for k in k_lst :
+				self.extract_map[k] = self[k, start:stop]
+		window = slice(start, stop).indices(self.array_len)[:2]
+		for k in k_lst :
+			self._window_map[k] = window
 		return self.extract_map
 
 	def get_stack(self) :
@@ -152,11 +476,43 @@ class RebHandler() :
 		stack = [self.extract_lst,] + [line for line in zip(* data_lst)]
 		return stack
 
-	def to_tsv(self, pth, start=None, stop=None) :
-		if not self.extract_map :
-			self.filter_all()
-		self.extract(start, stop)
-		pth.save(self.get_stack())
+	def to_tsv(self, pth, start=None, stop=None, step=None, filter_lst=None, chunk_len=2**14, sep='\t') :
+		""" write the selected variables in a text file, one column per variable, one line per record.
+		the records are read and formatted by chunks of chunk_len, the memory used does not depend on
+		the size of the recording. variables are the ones matching the glob patterns of filter_lst
+		if given, else the ones of extract_lst, else all of them """
+		if filter_lst :
+			match_set = set().union(* [self.meta.glob(pattern) for pattern in filter_lst])
+			name_lst = [name for name in self.meta if name in match_set]
+		elif self.extract_lst :
+			name_lst = list(self.extract_lst)
+		else :
+			name_lst = list(self.meta)
+
+		start, stop, step = slice(start, stop, step).indices(self.array_len)
+		if step <= 0 :
+			raise ValueError(f"step must be positive, got {step}")
+		chunk_len = max(1, chunk_len // step) * step # a multiple of step, for the chunks to follow each other
+
+		t = time.perf_counter()
+		record_nbr, byte_nbr = 0, 0
+		with Path(pth).open('wt') as fid :
+			byte_nbr += fid.write(sep.join(name_lst) + '\n')
+			for i in range(start, stop, chunk_len) :
+				rec = self[name_lst, i:min(i + chunk_len, stop):step]
+				if not name_lst :
+					line = '\n' * len(rec)
+				else :
+					col_lst = [rec[name].astype(str).tolist() for name in name_lst] # vectorized formatting, column by column
+					line = '\n'.join(map(sep.join, zip(* col_lst))) + '\n'
+				byte_nbr += fid.write(line)
+				record_nbr += len(rec)
+		t = time.perf_counter() - t
+
+		print(f"{pth}: {record_nbr} records of {len(name_lst)} variables, {byte_nbr} bytes written in {t:0.3f}s\n => {record_nbr / t:0.0f} records/s, {byte_nbr / t / 2**20:0.1f} MiB/s")
+
+	def to_csv(self, pth, start=None, stop=None, step=None, filter_lst=None, chunk_len=2**14) :
+		self.to_tsv(pth, start, stop, step, filter_lst, chunk_len, sep=',')
 
 	def to_listing(self, pth, at=None) :
 		if not self.extract_lst :
@@ -169,7 +525,8 @@ class RebHandler() :
 		else :
 			s = slice(0, 10)
 
-		stack = [[k,] + list(self[k][s]) for k in self.extract_lst]
+		rec = self[self.extract_lst, s]
+		stack = [[k,] + list(rec[k]) for k in self.extract_lst]
 		pth.save(stack)
 
 	def debug(self, pth) :
@@ -198,102 +555,9 @@ class RebHandler() :
 		self.to_listing(pth, n)
 		self.to_listing(pth.with_suffix('.1.tsv'), n-1)
 
-	def to_rez(self) :
-
-		""" en deux passes ? la première repère les vecteurs constants ou identiques 
-		la deuxième fourre tout dans un hdf5 ? mais ça fait lire le fichier 2 fois
-		
-		ou alors on stocke dans des fichiers temporaires pour chaque type
-
-		"""
-
-		import brotli
-
-		import h5py
-		try :
-			import hdf5plugin
-		except ImportError :
-			pass
-
-		archive_pth = self.data_pth.with_suffix('.rez')
-
-		try :
-			import hdf5plugin
-
-			h5py_opt = dict(
-				hdf5plugin.Blosc2(cname='zstd', clevel=9, filters=hdf5plugin.Blosc2.SHUFFLE | hdf5plugin.Blosc2.DELTA)
-			)
-		except :
-			h5py_opt = {
-				'compression' : "gzip",
-				'compression_opts' : 9,
-				'shuffle' : True,
-				# 'fletcher32' : True,
-			}
-
-		print(h5py_opt)
-
-		v_lst = list(self.meta)
-		r_lst = compact_name(v_lst)
-
-		# assert len(v_lst) == len(r_lst)
-
-		if archive_pth.is_file() :
-			archive_pth.unlink()
-
-		e_map = dict()
-		for c in ['R8', 'R4', 'Z4', 'Z2', 'Z1', 'N4', 'N2', 'N1'] :
-			i_lst = [i for i, v in enumerate(v_lst) if self.meta[v][0] == c]
-			print(f"{c} {0:7d} / {len(i_lst)}")
-			if i_lst :
-				e_map[c] = dict() # ctype -> name -> position
-				s = collections.defaultdict(set) # hash -> position set
-				m = list()
-				for n, i in enumerate(i_lst) :
-					v = v_lst[i] # full name of the variable
-					d = self[v] # full data line extracted
-					if d[0] == d[-1] and (d[0] == d).all() :
-						e_map[c][i] = ('=', d[0])
-						print(f"\x1b[A\x1b[K{c} {n+1:7d} / {len(i_lst)} # {d[0]} = {v_lst[i]}")
-					else :
-						h = hash(d.tobytes()) # hash of the line
-						j = len(m)
-						if h not in s :
-							s[h].add(j)
-							m.append(d)
-						else :
-							for j in s[h] :
-								if d.tobytes() == m[j].tobytes() :
-									break
-							else :
-								s[h].add(j)
-								m.append(d)
-						e_map[c][i] = ('@', j)
-						print(f"\x1b[A\x1b[K{c} {n+1:7d} / {len(i_lst)} # {j} @ {v_lst[i]}")
-
-				Path(f"s_map.{c}.json").save(s)
-
-				with h5py.File(archive_pth, 'a', libver="latest") as obj :
-					w = np.vstack(m)
-					print(f"\x1b[A\x1b[K{c} {len(i_lst):7d} / {len(i_lst)} => {w.shape[0]} rows")
-					print("RAAAH", w.shape)
-					obj.create_dataset('/' + c, data=w, ** h5py_opt)
-
-		f_lst = [str(self.array_len),] # on doit garder array_len dans les méta données parce qu'il se peut que TOUS les vecteurs soient constants
-		for i, (v, r) in enumerate(zip(v_lst, r_lst)) :
-			mtype = self.meta[v][0]
-			z, j = e_map[mtype][i]
-			f_lst.append(f'{r}\t{mtype}{z}{j}')
-
-		Path(archive_pth.with_suffix('.mez')).write_text('\n'.join(f_lst))
-
-		with h5py.File(archive_pth, 'a', libver="latest") as obj :
-			meta_zip = brotli.compress('\n'.join(f_lst).encode('ascii'), mode=brotli.MODE_TEXT)
-			obj.attrs['_meta'] = np.void(meta_zip) # https://docs.h5py.org/en/stable/strings.html
-
-		data_size = self.data_pth.stat().st_size
-		meta_size = self.meta_pth.stat().st_size
-		archive_size = archive_pth.stat().st_size
-		print(f"\noriginal: {data_size + meta_size:15d} bytes ({meta_size:8d} meta)\n archive: {archive_size:15d} bytes ({len(meta_zip):8d} meta)\n => archive takes {100.0 * archive_size / (data_size + meta_size):0.5}% of original")
-
-		return archive_pth
\ No newline at end of file
+	def to_rez(self, chunk_len=None, append=False) :
+		""" archive the recording in a .rez file, next to the .reb one, see RezArchiver.
+		with append, an existing archive is extended with the records written since """
+		from structarray.rezip import RezArchiver
+		archiver = RezArchiver(self, chunk_len)
+		return archiver.append() if append else archiver.archive()
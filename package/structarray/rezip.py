@@ -2,6 +2,7 @@
 
 import collections
 import json
+import math
 
 import brotli
 import h5py
@@ -16,40 +17,693 @@ import numpy as np
 
 from cc_pathlib import Path
 
-from structarray.meta import MetaRez, ntype_map
+from structarray.cache import MemoryCache
+from structarray.meta import MetaRez, sizeof_map, ntype_map, compact_name
 
 """
 .rez or rezip formats are compact binary files based on hdf5
 
-the mapping is embedded under a compact and compressed form
+the mapping is embedded under a compact and compressed form, each variable has a line
+<name> TAB <ctype><z><b> where z is the encoding of the column and b its parameter:
+
+	= constant, b is the value
+	@ row b of the dataset /<ctype>
+	/ linear ramp, b is (start, step)
+	% narrowed integers, b is (nctype, row, base), the column is base + row of /<nctype>
+	! bit-packed booleans, row b of /N1!
+	~ run-lengths, b is (first, count), the segments first:first+count of the values /<ctype>~
+	  which start at the records /<ctype>~start
 """
 
+def decode_ramp(mtype, start, step, i, j) :
+	""" records i:j of the ramp start + step * k, computed in the same way when archiving and reading.
+	start and step can also be arrays of shape (n, 1), for n ramps at once """
+	k = np.arange(i, j, dtype=np.int64)
+	if mtype.startswith('R') :
+		return (start + step * k.astype(np.float64)).astype(ntype_map[mtype])
+	else :
+		return (np.asarray(start, dtype=np.int64) + np.asarray(step, dtype=np.int64) * k).astype(ntype_map[mtype])
+
+def decode_column(obj, m, z, b, start, stop) :
+	""" decode the records start:stop of a column which is not constant, from the datasets of obj """
+	if z == '@' :
+		return obj[m][b,start:stop]
+	elif z == '/' :
+		return decode_ramp(m, * b, start, stop)
+	elif z == '%' :
+		nc, r, base = b
+		return obj[nc][r,start:stop].astype(ntype_map[m]) + np.array(base, dtype=ntype_map[m])
+	elif z == '!' :
+		return np.unpackbits(obj[m + '!'][b,start // 8:-(-stop // 8)])[start % 8:start % 8 + stop - start]
+	elif z == '~' :
+		first, count = b
+		start_arr = obj[m + '~start'][first:first + count]
+		value_arr = obj[m + '~'][first:first + count]
+		return value_arr[np.searchsorted(start_arr, np.arange(start, stop), 'right') - 1]
+	else :
+		raise ValueError(f"unknown encoding {z}")
+
 
 class RezHandler() :
-	def __init__(self) :
+	""" the .rez file stays open until close() is called, or the end of a with block.
+	decoded rows are kept in a least recently used cache of at most cache_size bytes,
+	since a row can be shared by many variables """
+
+	def __init__(self, cache_size=2**28) :
 		self.meta = MetaRez()
+		self.obj = None
+		self.row_cache = MemoryCache(cache_size) # (ctype, row) or (ctype, z, b) -> array
 
-	def load(self, pth) :
+	def load(self, pth, mode='r') :
 		self.pth = Path(pth).resolve()
 
 		assert self.pth.suffix == '.rez'
 
-		with h5py.File(self.pth, 'r', libver="latest") as obj :
-			self.meta.load(obj.attrs['_meta'])
+		self.close()
+		self.obj = h5py.File(self.pth, mode, libver="latest")
+		self.meta.load(self.obj.attrs['_meta'])
 
 		return self
 
-	def __getitem__(self, name) :
+	def close(self) :
+		if self.obj is not None :
+			self.obj.close()
+			self.obj = None
+		self.row_cache.clear()
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) :
+		self.close()
+
+	def _decode(self, m, z, b, start, stop) :
+		""" decode the records start:stop of a column which is not constant """
+		return decode_column(self.obj, m, z, b, start, stop)
+
+	def get_column(self, m, z, b) :
+		""" the complete column, decoded once and cached """
+		key = (m, b) if z == '@' else (m, z, b)
+		arr = self.row_cache.get(key)
+		if arr is None :
+			arr = self._decode(m, z, b, 0, self.meta.array_len)
+			arr.flags.writeable = False # shared by all the variables which refer to it
+			self.row_cache[key] = arr
+		return arr
+
+	def get(self, name, writable=False) :
+		""" constant columns are read-only views of a single value, with a stride of 0,
+		rows are read-only as well since they are cached. a writable copy is returned on demand """
 		m, z, b = self.meta[name]
 		if z == '=' :
-			return np.ones((self.meta.array_len,), dtype=ntype_map[m]) * b
-		elif z == '@' :
-			with h5py.File(self.pth, 'r', libver="latest") as obj :
-				return obj[m][b,:]
+			arr = np.broadcast_to(np.array(b, dtype=ntype_map[m]), (self.meta.array_len,))
+		else :
+			arr = self.get_column(m, z, b)
+		return arr.copy() if writable else arr
+
+	def __getitem__(self, name) :
+		return self.get(name)
+
+	def get_many(self, name_lst, start=None, stop=None) :
+		""" the columns of name_lst restricted to the records start:stop, return a dict name -> array.
+		the rows needed are grouped by dataset, sorted, and read with one selection per dataset,
+		only the chunks of the time window are decompressed """
+		start, stop, null = slice(start, stop).indices(self.meta.array_len)
+		stop = max(start, stop)
+		is_complete = (start, stop) == (0, self.meta.array_len)
+
+		data_map = dict() # (ctype, row) -> array
+		todo_map = collections.defaultdict(set) # ctype -> rows to be read
+		for name in name_lst :
+			m, z, b = self.meta[name]
+			if z == '@' and (m, b) not in data_map :
+				row = self.row_cache.get((m, b))
+				if row is not None :
+					data_map[(m, b)] = row[start:stop]
+				else :
+					todo_map[m].add(b)
+
+		for m, row_set in todo_map.items() :
+			row_lst = sorted(row_set)
+			block = self.obj[m][row_lst,start:stop] if start < stop else np.zeros((len(row_lst), 0), dtype=ntype_map[m])
+			block.flags.writeable = False
+			for b, row in zip(row_lst, block) :
+				if is_complete :
+					self.row_cache[(m, b)] = row
+				data_map[(m, b)] = row
+
+		res_map = dict()
+		for name in name_lst :
+			m, z, b = self.meta[name]
+			if z == '=' :
+				res_map[name] = np.broadcast_to(np.array(b, dtype=ntype_map[m]), (stop - start,))
+			elif z == '@' :
+				res_map[name] = data_map[(m, b)]
+			elif is_complete :
+				res_map[name] = self.get_column(m, z, b)
+			else :
+				arr = self.row_cache.get((m, z, b))
+				res_map[name] = arr[start:stop] if arr is not None else self._decode(m, z, b, start, stop)
+		return res_map
+
+
+
+class ClassState() :
+	""" the encoding of each class of variables of a type code, and the statistics of its column so far
+	(min, max, number of runs and last value), which are not known for the classes read from an archive
+	until they are needed """
+
+	array_lst = ['z', 'val', 'start', 'step', 'base', 'nbit', 'row', 'known', 'mn', 'mx', 'run', 'last']
+
+	def __init__(self, c, n=0) :
+		self.c = c
+		u = f'u{sizeof_map[c]}'
+
+		self.z = np.full((n,), '', dtype='U1') # '' until the encoding is chosen
+		self.val = np.zeros((n,), dtype=u) # = bits of the value
+		self.start = np.zeros((n,), dtype=np.float64 if c.startswith('R') else np.int64) # / ramp
+		self.step = np.zeros_like(self.start)
+		self.base = np.zeros((n,), dtype=ntype_map[c]) # % base, and size in bits of the narrowed integers
+		self.nbit = np.zeros((n,), dtype=np.int64)
+		self.row = np.full((n,), -1, dtype=np.int64) # @ % ! row in the dataset
+
+		self.known = np.ones((n,), dtype=bool)
+		self.mn = np.zeros((n,), dtype=ntype_map[c])
+		self.mx = np.zeros((n,), dtype=ntype_map[c])
+		self.run = np.zeros((n,), dtype=np.int64)
+		self.last = np.zeros((n,), dtype=u)
+
+		self.run_lst = [None,] * n # ~ runs kept in memory, as (start list, value list)
+		self.stored_lst = [None,] * n # ~ b of the runs already in the archive, while they do not change
+
+	def __len__(self) :
+		return len(self.z)
+
+	def take(self, index) :
+		other = ClassState(self.c)
+		for key in self.array_lst :
+			setattr(other, key, getattr(self, key)[index])
+		other.run_lst = [self.run_lst[p] for p in index.tolist()]
+		other.stored_lst = [self.stored_lst[p] for p in index.tolist()]
+		return other
+
+	def get_b(self, k) :
+		""" the parameter of the encoding of the class k, as written in the meta data """
+		z = self.z[k]
+		if z == '=' :
+			return self.val[k:k+1].view(ntype_map[self.c]).tolist()[0]
+		elif z == '/' :
+			return (self.start[k].item(), self.step[k].item())
+		elif z == '%' :
+			return (f'N{self.nbit[k] // 8}', int(self.row[k]), self.base[k].item())
+		elif z in '@!' :
+			return int(self.row[k])
+		elif z == '~' :
+			return self.stored_lst[k]
+		raise ValueError(f"unknown encoding {z}")
+
+	def set_b(self, k, z, b) :
+		self.z[k] = z
+		if z == '=' :
+			self.val[k:k+1] = np.array([b,], dtype=ntype_map[self.c]).view(self.val.dtype)
+		elif z == '/' :
+			self.start[k], self.step[k] = b
+		elif z == '%' :
+			nc, self.row[k], self.base[k] = b
+			self.nbit[k] = 8 * sizeof_map[nc]
+		elif z in '@!' :
+			self.row[k] = b
+		elif z == '~' :
+			self.stored_lst[k] = b
 		else :
-			raise ValueError
+			raise ValueError(f"unknown encoding {z}")
 
 
 class RezArchiver() :
-	def __init__(self) :
-		pass
+	""" write the .rez archive of a RebHandler, the .reb is read only once, by chunks of records, and each
+	chunk is written, already encoded, in the datasets of the archive.
+
+	for each type code, the variables are gathered in classes of identical columns, a class is split as
+	soon as its members differ on a chunk. the encoding of a class is chosen on its first chunk, and kept
+	as long as it holds (a constant does not change, a ramp goes on, narrowed integers stay in their
+	range...). when it does not, or when a class is split, the encoding is chosen again from the statistics
+	of the column so far (min, max, number of runs) and the records already archived are written again,
+	decoded from the former encoding.
+
+	all the variables of a type code are processed at once, values are compared bitwise (as unsigned
+	integers of the same size) so that a nan is equal to itself. the runs of the ~ columns are kept in
+	memory, at most run_size bytes for each type code, and written at the end """
+
+	ctype_lst = ['R8', 'R4', 'Z8', 'Z4', 'Z2', 'Z1', 'N8', 'N4', 'N2', 'N1']
+	time_chunk_len = 2**16 # length of the hdf5 chunks along the time axis
+	run_size = 2**26 # bytes of runs kept in memory for each type code
+
+	def __init__(self, reb, chunk_len=None) :
+		self.reb = reb
+		self.chunk_len = max(1, reb.chunk_size // reb.meta.sizeof) if chunk_len is None else chunk_len
+
+		# rows are chunked along the time axis, so that a time window does not decompress the whole row,
+		# and the records are read by a multiple of it, so that each chunk is written at once. the chunks
+		# do not depend on the length of the recording, the rows keep growing with append()
+		if self.time_chunk_len <= self.chunk_len :
+			self.chunk_len -= self.chunk_len % self.time_chunk_len
+
+		try :
+			self.h5py_opt = dict(
+				hdf5plugin.Blosc2(cname='zstd', clevel=9, filters=hdf5plugin.Blosc2.SHUFFLE | hdf5plugin.Blosc2.DELTA)
+			)
+		except NameError :
+			self.h5py_opt = {
+				'compression' : "gzip",
+				'compression_opts' : 9,
+				'shuffle' : True,
+				# 'fletcher32' : True,
+			}
+
+	def archive(self, archive_pth=None) :
+		reb = self.reb
+
+		if reb.array_len == 0 :
+			raise ValueError(f"{reb.data_pth} contains no complete record")
+
+		archive_pth = reb.data_pth.with_suffix('.rez') if archive_pth is None else Path(archive_pth).resolve()
+		if archive_pth.is_file() :
+			archive_pth.unlink()
+
+		self._prepare()
+		self.class_map = dict() # ctype -> class of each variable
+		self.state_map = dict() # ctype -> ClassState
+		for c, n_lst in self.name_map.items() :
+			self.class_map[c] = np.zeros((len(n_lst),), dtype=np.int64)
+			self.state_map[c] = ClassState(c, 1)
+
+		with h5py.File(archive_pth, 'w', libver="latest") as obj :
+			self.obj = obj
+			self._scan(0)
+			meta_zip = self._write_meta(archive_pth, self._finish())
+
+		self._report(archive_pth, meta_zip)
+
+		return archive_pth
+
+	def append(self, archive_pth=None) :
+		""" extend an existing archive with the records appended to the .reb since it was written.
+		the classes of variables keep their encoding as long as it holds for the new records, the others
+		are encoded again. the meta data, with the new array_len, is replaced last, in a single write:
+		until then, the archive is still valid for its former length """
+		reb = self.reb
+
+		archive_pth = reb.data_pth.with_suffix('.rez') if archive_pth is None else Path(archive_pth).resolve()
+		if not archive_pth.is_file() :
+			return self.archive(archive_pth)
+
+		self.rez = RezHandler(cache_size=0).load(archive_pth, mode='r+')
+		self.obj = self.rez.obj
+
+		prev_len = self.rez.meta.array_len
+		is_appendable = list(self.rez.meta._m) == list(reb.meta) and all(
+			self.rez.meta[v][0] == reb.meta[v][0] for v in reb.meta
+		) and all(
+			self.obj[key].maxshape[-1] is None for key in self.obj if self.obj[key].ndim == 2
+		)
+		if not is_appendable or reb.array_len < prev_len :
+			self.rez.close()
+			print(f"! {archive_pth} can not be extended, it is archived again")
+			return self.archive(archive_pth)
+		if reb.array_len == prev_len :
+			self.rez.close()
+			return archive_pth
+
+		self._prepare()
+		self.class_map = dict() # ctype -> class of each variable
+		self.state_map = dict() # ctype -> ClassState
+		for c, n_lst in self.name_map.items() :
+			key_map = dict() # (z, b) -> class
+			self.class_map[c] = np.array([key_map.setdefault(self.rez.meta[v][1:], len(key_map)) for v in n_lst], dtype=np.int64)
+			self.state_map[c] = st = ClassState(c, len(key_map))
+			for k, (z, b) in enumerate(key_map) :
+				st.set_b(k, z, b)
+				self._load_stat(st, k, prev_len)
+
+		for key in self.obj :
+			if self.obj[key].ndim == 2 :
+				self.obj[key].resize(-(-reb.array_len // 8) if key.endswith('!') else reb.array_len, axis=1)
+
+		try :
+			self._scan(prev_len)
+			meta_zip = self._write_meta(archive_pth, self._finish())
+		finally :
+			self.rez.close()
+
+		self._report(archive_pth, meta_zip)
+
+		return archive_pth
+
+	def _load_stat(self, st, k, n) :
+		""" the statistics of a class read from the archive, when they can be known without decoding it,
+		the runs of a ~ class are loaded in memory """
+		z = st.z[k]
+		if z == '=' :
+			st.mn[k] = st.mx[k] = st.val[k:k+1].view(st.mn.dtype)[0]
+			st.run[k], st.last[k] = 1, st.val[k]
+		elif z == '~' :
+			first, count = st.stored_lst[k]
+			start_arr = self.obj[st.c + '~start'][first:first + count].astype(np.int64)
+			value_arr = self.obj[st.c + '~'][first:first + count]
+			st.run_lst[k] = ([start_arr,], [value_arr,])
+			st.mn[k], st.mx[k] = (value_arr.min(), value_arr.max()) if st.c[0] in 'NZ' else (0, 0)
+			st.run[k], st.last[k] = count, value_arr[-1:].view(st.last.dtype)[0]
+		else :
+			st.known[k] = False
+
+	def _prepare(self) :
+		self.name_map = {c : [v for v in self.reb.meta if self.reb.meta[v][0] == c] for c in self.ctype_lst} # ctype -> names
+		self.name_map = {c : n_lst for c, n_lst in self.name_map.items() if n_lst}
+
+		self.index_map = dict() # ctype -> position of the bytes of each variable in a record
+		for c, n_lst in self.name_map.items() :
+			self.index_map[c] = np.array([self.reb.meta[v][1] for v in n_lst])[:,None] + np.arange(sizeof_map[c])
+
+	def _scan(self, start) :
+		""" read the records from start by chunks, for each one, all the variables of a type code are
+		gathered at once, one line per variable, then the chunk is written in the archive """
+		reb = self.reb
+		print(f"{start:10d} / {reb.array_len} records")
+		for i in range(start, reb.array_len, self.chunk_len) :
+			block = reb.data[i:i + self.chunk_len] # (records, sizeof) bytes
+			write_map = collections.defaultdict(list) # dataset -> (rows, data) to be written
+			for c in self.name_map :
+				m = np.ascontiguousarray(np.ascontiguousarray(block[:,self.index_map[c]]).view(ntype_map[c])[:,:,0].T)
+				self._push(c, m, i, write_map)
+			self._flush(write_map, i, len(block))
+			print(f"\x1b[A\x1b[K{i + len(block):10d} / {reb.array_len} records")
+
+	def _finish(self) :
+		""" write the runs kept in memory, return the encoding of each variable """
+		e_map = dict() # name -> encoding
+		for c, n_lst in self.name_map.items() :
+			st = self.state_map[c]
+			for k in np.flatnonzero(st.z == '~').tolist() :
+				if st.stored_lst[k] is None :
+					s_lst, v_lst = st.run_lst[k]
+					start_arr = np.concatenate(s_lst)
+					st.stored_lst[k] = (self._extend(c + '~start', start_arr.astype(np.uint64)), len(start_arr))
+					self._extend(c + '~', np.concatenate(v_lst))
+			b_lst = [st.get_b(k) for k in range(len(st))]
+			for v, k in zip(n_lst, self.class_map[c].tolist()) :
+				e_map[v] = (st.z[k], b_lst[k])
+			z_cnt = collections.Counter(st.z.tolist())
+			print(f"{c} {len(n_lst):7d} variables => {len(st)} classes " + ' '.join(f"{z}{z_cnt[z]}" for z in sorted(z_cnt)))
+		return e_map
+
+	def _write_meta(self, archive_pth, e_map) :
+		v_lst = list(self.reb.meta)
+		r_lst = compact_name(v_lst)
+
+		f_lst = [str(self.reb.array_len),] # on doit garder array_len dans les méta données parce qu'il se peut que TOUS les vecteurs soient constants
+		for v, r in zip(v_lst, r_lst) :
+			z, b = e_map[v]
+			f_lst.append(f'{r}\t{self.reb.meta[v][0]}{z}{b}')
+
+		meta_zip = brotli.compress('\n'.join(f_lst).encode('ascii'), mode=brotli.MODE_TEXT)
+		self.obj.attrs['_meta'] = np.void(meta_zip) # https://docs.h5py.org/en/stable/strings.html
+
+		Path(archive_pth.with_suffix('.mez')).write_text('\n'.join(f_lst))
+
+		return meta_zip
+
+	def _report(self, archive_pth, meta_zip) :
+		data_size = self.reb.data_pth.stat().st_size
+		meta_size = self.reb.meta_pth.stat().st_size
+		archive_size = archive_pth.stat().st_size
+		print(f"\noriginal: {data_size + meta_size:15d} bytes ({meta_size:8d} meta)\n archive: {archive_size:15d} bytes ({len(meta_zip):8d} meta)\n => archive takes {100.0 * archive_size / (data_size + meta_size):0.5}% of original")
+
+	def _push(self, c, m, i, write_map) :
+		""" refine the classes of the type code c with the chunk m, one line per variable, which starts at the
+		record i, check the encodings against it, and add the encoded chunk of each class to write_map """
+		size = sizeof_map[c]
+		u = m.view(f'u{size}') # bitwise comparisons
+		n = i + m.shape[1] # length of the columns, this chunk included
+
+		# identical lines get the same group, lines are sorted as raw bytes, there is no collision to deal with
+		group_arr = np.unique(u.view(np.dtype((np.void, u.shape[1] * u.itemsize)))[:,0], return_inverse=True)[1].ravel()
+
+		# the new classes are the distinct pairs (former class, group), they start with the state of their former class
+		class_arr = self.class_map[c]
+		null, rep_arr, new_arr = np.unique(class_arr * (group_arr.max() + 1) + group_arr, return_index=True, return_inverse=True)
+		prev_arr = class_arr[rep_arr] # former class of each new class
+		st = self.state_map[c]
+		if len(rep_arr) != len(st) :
+			st = st.take(prev_arr)
+		d, du = m[rep_arr], u[rep_arr]
+
+		# statistics of the chunk, then of the whole column
+		first = du[:,0]
+		change = du[:,1:] != du[:,:-1]
+		c_run = change.sum(axis=1)
+		if c[0] in 'NZ' :
+			c_mn, c_mx = d.min(axis=1), d.max(axis=1)
+		else :
+			c_mn = c_mx = np.zeros((len(d),), dtype=d.dtype)
+		last = st.last.copy()
+		if 0 < i :
+			st.run = st.run + c_run + (first != last)
+			st.mn, st.mx = np.minimum(st.mn, c_mn), np.maximum(st.mx, c_mx)
+		else :
+			st.run = c_run + 1
+			st.mn, st.mx = c_mn, c_mx
+		st.last = du[:,-1].copy()
+
+		# does the encoding still hold
+		holds = st.z == '@'
+		for z, sel in [(z, np.flatnonzero(st.z == z)) for z in '=/%!~'] :
+			if not len(sel) :
+				continue
+			if z == '=' :
+				holds[sel] = (c_run[sel] == 0) & (first[sel] == st.val[sel])
+			elif z == '/' :
+				e = decode_ramp(c, st.start[sel,None], st.step[sel,None], i, n)
+				holds[sel] = (e.view(u.dtype) == du[sel]).all(axis=1)
+			elif z == '%' :
+				lim = (np.uint64(1) << st.nbit[sel].astype(np.uint64)) - np.uint64(1)
+				holds[sel] = (st.base[sel] <= c_mn[sel]) & ((c_mx[sel].view(u.dtype) - st.base[sel].view(u.dtype)) <= lim)
+			elif z == '!' :
+				holds[sel] = c_mx[sel] <= 1
+			elif z == '~' :
+				holds[sel] = st.run[sel] * (size + 8) <= self._get_cost(c, n, st.mn[sel], st.mx[sel])
+		# the largest runs are dropped when there are too many to be kept in memory
+		no_run = np.zeros(holds.shape, dtype=bool)
+		sel = np.flatnonzero(holds & (st.z == '~'))
+		sel = sel[np.argsort(- st.run[sel], kind='stable')]
+		excess = st.run[sel].sum() * (size + 8) - self.run_size
+		if 0 < excess :
+			drop = sel[:np.searchsorted(np.cumsum(st.run[sel]) * (size + 8), excess) + 1]
+			holds[drop], no_run[drop] = False, True
+
+		# for each former class whose encoding holds, the first of its new classes keeps it
+		k_arr = np.flatnonzero(holds)
+		k_arr = k_arr[np.unique(prev_arr[k_arr], return_index=True)[1]]
+		keep = np.zeros(holds.shape, dtype=bool)
+		keep[k_arr] = True
+
+		# the new runs of the ~ classes which are kept
+		sel = np.flatnonzero(keep & (st.z == '~'))
+		if len(sel) :
+			is_new = np.concatenate(((first[sel] != last[sel])[:,None], change[sel]), axis=1)
+			r_arr, j_arr = np.nonzero(is_new)
+			for q, a, b in zip(* np.unique(r_arr, return_index=True, return_counts=True)) :
+				k = sel[q]
+				s_lst, v_lst = st.run_lst[k]
+				st.run_lst[k] = (s_lst + [i + j_arr[a:a+b],], v_lst + [d[k,j_arr[a:a+b]],])
+				st.stored_lst[k] = None
+
+		stat_map = dict() # former class -> statistics of its records before i, when they were not known
+		for k in np.flatnonzero(~ keep).tolist() :
+			if not st.known[k] :
+				p = prev_arr[k]
+				if p not in stat_map :
+					stat_map[p] = self._get_stat(st, k, i)
+				mn, mx, run, z_last = stat_map[p]
+				st.mn[k], st.mx[k] = min(mn, c_mn[k]), max(mx, c_mx[k])
+				st.run[k] = run + c_run[k] + (first[k] != z_last)
+				st.known[k] = True
+			self._refit(st, k, i, d[k], no_run[k])
+
+		# the chunk, encoded, is given to _flush()
+		for z, sel in [(z, np.flatnonzero(st.z == z)) for z in '@%!'] :
+			if not len(sel) :
+				continue
+			if z == '@' :
+				write_map[c].append((st.row[sel], d[sel]))
+			elif z == '%' :
+				for nbit in np.unique(st.nbit[sel]).tolist() :
+					q = sel[st.nbit[sel] == nbit]
+					nc = f'N{nbit // 8}'
+					write_map[nc].append((st.row[q], (d[q] - st.base[q,None]).astype(ntype_map[nc])))
+			elif z == '!' :
+				write_map[c + '!'].append((st.row[sel], d[sel]))
+
+		self.class_map[c] = new_arr.ravel()
+		self.state_map[c] = st
+
+	def _get_cost(self, c, n, mn, mx) :
+		""" number of bytes of n records of the columns of min mn and max mx (arrays), in their cheapest
+		encoding which is not a run length one """
+		size = sizeof_map[c]
+		cost = np.full(mn.shape, n * size, dtype=np.int64)
+		if c == 'N1' :
+			cost[mx <= 1] = -(-n // 8)
+		elif c[0] in 'NZ' :
+			span = mx.view(f'u{size}') - mn.view(f'u{size}')
+			for nsize in [4, 2, 1] :
+				if nsize < size :
+					cost[span < 2**(8 * nsize)] = n * nsize
+		return cost
+
+	def _get_stat(self, st, k, i) :
+		""" min, max, number of runs and bits of the last value of the records 0:i of the class k,
+		decoded from the archive """
+		u = st.last.dtype
+		mn, mx, run, z_last = None, None, 0, None
+		for j in range(0, i, self.chunk_len) :
+			e = self._decode(st, k, j, min(j + self.chunk_len, i))
+			eu = e.view(u)
+			run += int((eu[1:] != eu[:-1]).sum()) + int(z_last is None or eu[0] != z_last)
+			z_last = eu[-1]
+			if st.c[0] in 'NZ' :
+				mn = e.min() if mn is None else min(mn, e.min())
+				mx = e.max() if mx is None else max(mx, e.max())
+		return (mn, mx, run, z_last) if st.c[0] in 'NZ' else (0, 0, run, z_last)
+
+	def _decode(self, st, k, j, jj) :
+		""" records j:jj of the class k, in its current encoding """
+		c, z = st.c, st.z[k]
+		if z == '=' :
+			return np.full((jj - j,), st.val[k], dtype=st.val.dtype).view(ntype_map[c])
+		elif z == '~' :
+			s_lst, v_lst = st.run_lst[k]
+			start_arr, value_arr = np.concatenate(s_lst), np.concatenate(v_lst)
+			return value_arr[np.searchsorted(start_arr, np.arange(j, jj), 'right') - 1]
+		return decode_column(self.obj, c, z, st.get_b(k), j, jj)
+
+	def _refit(self, st, k, i, d, no_run=False) :
+		""" choose the encoding of the class k, whose column is the records 0:i in its current encoding,
+		followed by the chunk d. the records 0:i are written in the new encoding, the chunk is left to the
+		caller, but for the runs which are computed here """
+		c = st.c
+		size = sizeof_map[c]
+		n = i + len(d)
+		mn, mx, run = st.mn[k].item(), st.mx[k].item(), int(st.run[k])
+
+		cost_map = {'@' : n * size}
+		if run == 1 :
+			cost_map['='] = -1
+		if i == 0 and self._is_ramp(c, d) :
+			cost_map['/'] = 0
+		if not no_run :
+			cost_map['~'] = run * (size + 8)
+		if c == 'N1' and mx <= 1 :
+			cost_map['!'] = -(-n // 8)
+		if c[0] in 'NZ' :
+			for nc in ['N1', 'N2', 'N4'] :
+				if sizeof_map[nc] < size and mx - mn < 2**(8 * sizeof_map[nc]) :
+					cost_map['%'] = n * sizeof_map[nc]
+					break
+		z = min(cost_map, key=cost_map.get)
+
+		if z == '=' :
+			b = d[:1].tolist()[0]
+		elif z == '/' :
+			b = self._is_ramp(c, d)
+		elif z == '@' :
+			b = self._new_row(c, ntype_map[c], self.reb.array_len)
+			for j in range(0, i, self.chunk_len) :
+				jj = min(j + self.chunk_len, i)
+				self.obj[c][b,j:jj] = self._decode(st, k, j, jj)
+		elif z == '%' :
+			# the range is centered in the narrowed integers, for the values to come to have some margin
+			t = np.iinfo(ntype_map[c])
+			base = max(t.min, mn - (2**(8 * sizeof_map[nc]) - 1 - (mx - mn)) // 2)
+			b = (nc, self._new_row(nc, ntype_map[nc], self.reb.array_len), base)
+			for j in range(0, i, self.chunk_len) :
+				jj = min(j + self.chunk_len, i)
+				self.obj[nc][b[1],j:jj] = (self._decode(st, k, j, jj) - np.array(base, dtype=ntype_map[c])).astype(ntype_map[nc])
+		elif z == '!' :
+			b = self._new_row(c + '!', np.uint8, -(-self.reb.array_len // 8))
+			step = max(8, self.chunk_len - self.chunk_len % 8) # whole bytes, but for the last one
+			for j in range(0, i, step) :
+				e = np.packbits(self._decode(st, k, j, min(j + step, i)))
+				self.obj[c + '!'][b,j // 8:j // 8 + len(e)] = e
+		elif z == '~' :
+			s_lst, v_lst = list(), list()
+			u, z_last = st.last.dtype, None
+			for j in range(0, i, self.chunk_len) :
+				e = self._decode(st, k, j, min(j + self.chunk_len, i))
+				s_lst.append(j + np.flatnonzero(np.concatenate(([z_last is None or e[:1].view(u)[0] != z_last], e.view(u)[1:] != e.view(u)[:-1]))))
+				v_lst.append(e[s_lst[-1] - j])
+				z_last = e[-1:].view(u)[0]
+			s_lst.append(i + np.flatnonzero(np.concatenate(([z_last is None or d[:1].view(u)[0] != z_last], d.view(u)[1:] != d.view(u)[:-1]))))
+			v_lst.append(d[s_lst[-1] - i])
+			b = None
+
+		st.set_b(k, z, b)
+		st.run_lst[k] = (s_lst, v_lst) if z == '~' else None
+		if z != '~' :
+			st.stored_lst[k] = None
+
+	def _is_ramp(self, c, d) :
+		""" return (start, step) if d is exactly a linear ramp, else None """
+		if len(d) < 2 :
+			return None
+		if c.startswith('R') :
+			start, step = float(d[0]), float(d[1]) - float(d[0])
+			if not (math.isfinite(start) and math.isfinite(step)) :
+				return None
+		else :
+			# as int64, the ramp of the larger unsigned integers wraps in the same way when it is decoded
+			e = d[:2].astype(np.int64)
+			start, step = int(e[0]), int((e[1:] - e[:1])[0])
+		u = f'u{sizeof_map[c]}'
+		return (start, step) if (decode_ramp(c, start, step, 0, len(d)).view(u) == d.view(u)).all() else None
+
+	def _new_row(self, key, dtype, width) :
+		""" add a row of width records to the dataset key of the archive, return its index """
+		if key not in self.obj :
+			self.obj.create_dataset('/' + key, shape=(0, width), maxshape=(None, None),
+				dtype=dtype, chunks=(1, self.time_chunk_len), ** self.h5py_opt)
+		dset = self.obj[key]
+		r = dset.shape[0]
+		dset.resize(r + 1, axis=0)
+		return r
+
+	def _flush(self, write_map, i, chunk_len) :
+		""" write the records i:i+chunk_len of the rows of each dataset at once, the rows which are no
+		longer used by any class are filled with zeros """
+		for key, w_lst in write_map.items() :
+			dset = self.obj[key]
+			if key.endswith('!') :
+				a, r = divmod(i, 8)
+				block = np.zeros((dset.shape[0], r + chunk_len), dtype=np.uint8)
+				if r :
+					# the first byte is partially filled, its first bits are kept
+					block[:,:r] = np.unpackbits(dset[:,a:a + 1], axis=1)[:,:r]
+				for row, d in w_lst :
+					block[row,r:] = d
+				block = np.packbits(block, axis=1)
+				dset[:,a:a + block.shape[1]] = block
+			else :
+				block = np.zeros((dset.shape[0], chunk_len), dtype=dset.dtype)
+				for row, d in w_lst :
+					block[row] = d
+				dset[:,i:i + chunk_len] = block
+
+	def _extend(self, key, d) :
+		""" append d at the end of the one dimensional dataset key of the archive, return the position of d """
+		if key not in self.obj :
+			self.obj.create_dataset('/' + key, shape=(0,), maxshape=(None,),
+				dtype=d.dtype, chunks=(self.time_chunk_len,), ** self.h5py_opt)
+		dset = self.obj[key]
+		p = dset.shape[0]
+		dset.resize(p + len(d), axis=0)
+		dset[p:] = d
+		return p
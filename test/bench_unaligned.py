@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from cc_pathlib import Path
+
+from structarray.meta import MetaReb
+from structarray.rebin import RebHandler
+
+""" compare the extraction speed of aligned and unaligned variables, both should be
+of the same order of magnitude. usage: bench_unaligned.py [RECORD_NBR] """
+
+array_len = int(sys.argv[1]) if 1 < len(sys.argv) else 2**20
+
+var_lst = [ # name, ctype, offset
+	["aligned.R8", 'R8', 0],
+	["aligned.R4", 'R4', 8],
+	["aligned.Z2", 'Z2', 12],
+	["flag", 'N1', 14],
+	["unaligned.R8", 'R8', 15],
+	["unaligned.R4", 'R4', 23],
+	["unaligned.Z2", 'Z2', 27],
+]
+sizeof = 32
+
+with tempfile.TemporaryDirectory() as tmp_dir :
+	tmp_dir = Path(tmp_dir)
+
+	meta = MetaReb("bench_t", sizeof)
+	for name, ctype, offset in var_lst :
+		meta.push(name, ctype, offset)
+	meta.dump(tmp_dir / "mapping.tsv")
+
+	rng = np.random.default_rng(0)
+	(tmp_dir / "bench.reb").write_bytes(rng.integers(0, 256, array_len * sizeof, dtype=np.uint8).tobytes())
+
+	u = RebHandler().load(tmp_dir / "bench.reb")
+
+	for name, ctype, offset in var_lst :
+		t = time.perf_counter()
+		arr = np.array(u[name]) # force the copy, a view would cost nothing
+		t = time.perf_counter() - t
+		print(f"{name:16s} {ctype} aligned={u.meta.is_aligned(name)!s:5s} {1e9 * t / array_len:8.3f} ns/sample")
+
+	del u
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+""" the two tiers of CacheHandler, and a cache file shared by handlers and processes """
+
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from cc_pathlib import Path
+
+from structarray.cache import CacheHandler, MemoryCache
+from structarray.meta import MetaReb
+from structarray.rebin import RebHandler
+
+def make_recording(tmp_dir, array_len=1000) :
+	meta = MetaReb("cache_t", 16)
+	meta.push("a", 'R8', 0)
+	meta.push("b", 'Z4', 8)
+	meta.push("c", 'N4', 12)
+	meta.dump(tmp_dir / "mapping.tsv")
+
+	rec = np.zeros((array_len,), dtype=np.dtype({'names' : ['a', 'b', 'c'], 'formats' : ['<f8', '<i4', '<u4'], 'offsets' : [0, 8, 12], 'itemsize' : 16}))
+	rec['a'] = np.arange(array_len) * 0.5
+	rec['b'] = - np.arange(array_len)
+	rec['c'] = 7
+	(tmp_dir / "rec.reb").write_bytes(rec.tobytes())
+	return rec
+
+def test_memory_cache() :
+	u = MemoryCache(max_size=3 * 80)
+	for i in range(4) :
+		u[i] = np.zeros((10,))
+	assert 0 not in u and len(u) == 3 and u.stats()['eviction'] == 1
+	u.get(1)
+	u[4] = np.zeros((10,))
+	assert 1 in u and 2 not in u
+	u[5] = np.zeros((100,)) # larger than the cache, not kept
+	assert 5 not in u
+
+def test_cache_handler() :
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		pth = Path(tmp_dir) / "cache.hdf5"
+
+		u = CacheHandler(pth, "sig-1", max_size=2**10)
+		arr = np.arange(10)
+		u['x'] = arr
+		u['y'] = arr.copy() # same content, stored once
+		arr[0] = 5 # the caller keeps its array, writable
+		assert u['x'][0] == 0 and not u['x'].flags.writeable
+		assert u.stats()['file']['unique'] == 1
+
+		v = CacheHandler(pth, "sig-1") # another handler on the same file, while u is alive
+		assert 'x' in v and (v['x'] == np.arange(10)).all()
+
+		w = CacheHandler(pth, "sig-2") # the signature changed, the file is cleared
+		assert 'x' not in w and w.get('x') is None
+
+		# the same bytes, with other shapes, are distinct columns
+		w['m[2][3]'] = np.zeros((100, 2, 3))
+		w['k[3][2]'] = np.zeros((100, 3, 2))
+		writer = w.open_writer(['n[6]'], [np.dtype(('<f8', (6,)))], 100)
+		writer.write(0, {'n[6]' : np.zeros((100, 6))})
+		writer.commit()
+		z = CacheHandler(pth, "sig-2")
+		assert z['m[2][3]'].shape == (100, 2, 3) and z['k[3][2]'].shape == (100, 3, 2) and z['n[6]'].shape == (100, 6)
+		assert z.stats()['file']['unique'] == 3
+
+def test_shared_file() :
+	RebHandler.huge_file_size, huge_file_size = 1, RebHandler.huge_file_size
+	try :
+		with tempfile.TemporaryDirectory() as tmp_dir :
+			tmp_dir = Path(tmp_dir)
+			rec = make_recording(tmp_dir)
+
+			with RebHandler().load(tmp_dir / "rec.reb") as u, RebHandler().load(tmp_dir / "rec.reb") as v :
+				assert isinstance(u.cache, CacheHandler) and isinstance(v.cache, CacheHandler)
+				assert (u['a'] == rec['a']).all()
+				assert v.cache.get('a') is not None and (v['a'] == rec['a']).all()
+
+				# a window is read from the recording, unless the column is already in memory
+				x = RebHandler().load(tmp_dir / "rec.reb")
+				assert (x['a', 10:20] == rec['a'][10:20]).all() and x.cache.stats()['file']['hit'] == 0
+				assert (v['a', 10:20] == rec['a'][10:20]).all() and v.cache.stats()['memory']['hit'] == 2
+				x.close()
+
+				# the recording grows while u and v are alive, the cache file is created again
+				with (tmp_dir / "rec.reb").open('ab') as fid :
+					fid.write(rec[:10].tobytes())
+				w = RebHandler().load(tmp_dir / "rec.reb")
+				assert 'a' not in w.cache and len(w['a']) == len(rec) + 10
+				w.close()
+
+				# the file now belongs to the new recording, u neither reads nor writes it
+				u.cache.memory.clear()
+				assert u.cache.get('a') is None and (u['a'] == rec['a']).all()
+				assert len(RebHandler().load(tmp_dir / "rec.reb").cache.get('a')) == len(rec) + 10
+
+			# another process keeps the file open, the cache stays in memory
+			code = f"import h5py, sys, time ; obj = h5py.File({str(tmp_dir / 'rec.__cache__.hdf5')!r}, 'a') ; print('', flush=True) ; time.sleep(3)"
+			proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True)
+			proc.stdout.readline()
+			with RebHandler().load(tmp_dir / "rec.reb") as z :
+				assert isinstance(z.cache, MemoryCache)
+				assert (z['b'][:len(rec)] == rec['b']).all()
+			proc.wait()
+	finally :
+		RebHandler.huge_file_size = huge_file_size
+
+if __name__ == '__main__' :
+	test_memory_cache()
+	test_cache_handler()
+	test_shared_file()
+	print("cache ok")
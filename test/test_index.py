@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+""" the queries on the names of a mapping: prefix, subtree, glob and children """
+
+import tempfile
+
+import numpy as np
+
+from cc_pathlib import Path
+
+from structarray.meta import MetaReb, NameIndex
+from structarray.rebin import RebHandler
+
+name_lst = ['ctx.a', 'ctx.ab', 'ctx.b.x', 'ctx.b.y', 'ctx.m[0]', 'ctx.m[1]', 'ctx.pos@2', 'ctx', 'other.a', 'ctx2.a']
+
+def test_prefix() :
+	u = NameIndex(name_lst)
+	assert u.prefix('ctx.a') == ['ctx.a', 'ctx.ab']
+	assert u.prefix('ctx.b.') == ['ctx.b.x', 'ctx.b.y']
+	assert u.prefix('ctx') == ['ctx.a', 'ctx.ab', 'ctx.b.x', 'ctx.b.y', 'ctx.m[0]', 'ctx.m[1]', 'ctx.pos@2', 'ctx', 'ctx2.a']
+	assert u.prefix('none') == list()
+	assert len(u) == len(name_lst) and 'ctx.b.x' in u and 'ctx.b' not in u
+
+def test_subtree() :
+	u = NameIndex(name_lst)
+	assert u.subtree('ctx') == ['ctx.a', 'ctx.ab', 'ctx.b.x', 'ctx.b.y', 'ctx.m[0]', 'ctx.m[1]', 'ctx.pos@2', 'ctx'] # ctx2.a is not below ctx
+	assert u.subtree('ctx.m') == ['ctx.m[0]', 'ctx.m[1]']
+	assert u.subtree('ctx.pos') == ['ctx.pos@2']
+	assert u.subtree('ctx.a') == ['ctx.a']
+	assert u.subtree('') == name_lst
+
+def test_glob() :
+	u = NameIndex(name_lst)
+	assert u.glob('ctx.a') == ['ctx.a'] # no wildcard, an exact match
+	assert u.glob('ctx.b') == list()
+	assert u.glob('ctx.?') == ['ctx.a']
+	assert u.glob('ctx.*') == ['ctx.a', 'ctx.ab', 'ctx.b.x', 'ctx.b.y', 'ctx.m[0]', 'ctx.m[1]', 'ctx.pos@2'] # * goes through the dots
+	assert u.glob('*.a') == ['ctx.a', 'other.a', 'ctx2.a'] # the whole name must match
+	assert u.glob('ctx.m[?]') == ['ctx.m[0]', 'ctx.m[1]'] # brackets are not special
+
+def test_children() :
+	u = NameIndex(name_lst)
+	assert u.children() == ['ctx', 'other', 'ctx2']
+	assert u.children('ctx') == ['a', 'ab', 'b', 'm[0]', 'm[1]', 'pos@2']
+	assert u.children('ctx.b') == ['x', 'y']
+	assert u.children('ctx.a') == list()
+	try :
+		u.children('ctx.c')
+	except KeyError :
+		pass
+	else :
+		raise AssertionError("children of an unknown node")
+
+def test_meta() :
+	meta = MetaReb("index_t", 24)
+	meta.push("ctx.a", 'R4', 0)
+	meta.push("ctx.m[2]", 'R4', 4, (4,))
+	meta.push("ctx.ptr", 'P8', 16)
+	assert meta.glob('ctx.*') == ['ctx.a', 'ctx.m[0]', 'ctx.m[1]'] # the elements of the arrays, not the pointers
+	assert meta.children('ctx') == ['a', 'm[0]', 'm[1]']
+	assert len(meta) == len(list(meta)) == 3 and meta.entry_nbr() == 3
+	meta.push("ctx.b", 'R4', 12) # the index is built again
+	assert meta.prefix('ctx.b') == ['ctx.b']
+
+def test_to_tsv() :
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		meta = MetaReb("tsv_t", 12)
+		meta.push("a", 'Z4', 0)
+		meta.push("ab", 'Z4', 4)
+		meta.push("b.a", 'Z4', 8)
+		meta.dump(tmp_dir / "mapping.tsv")
+		(tmp_dir / "rec.reb").write_bytes(np.arange(30, dtype=np.int32).tobytes())
+
+		u = RebHandler().load(tmp_dir / "rec.reb")
+		u.to_tsv(tmp_dir / "out.tsv", filter_lst=['a']) # the same names as filter_select()
+		u.filter_select('a')
+		assert (tmp_dir / "out.tsv").read_text().splitlines()[0].split('\t') == u.extract_lst == ['a']
+
+if __name__ == '__main__' :
+	test_prefix()
+	test_subtree()
+	test_glob()
+	test_children()
+	test_meta()
+	test_to_tsv()
+	print("index ok")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+""" round trip of a recording through the .rbz block compression, and random access by the frame index """
+
+import tempfile
+
+import numpy as np
+
+from cc_pathlib import Path
+
+from structarray.block_compress import BlockReader, block_compress, block_decompress
+
+block_size = 24
+keyframe_len = 16
+
+def make_recording(pth, block_nbr, tail=0) :
+	""" block_nbr blocks which change slowly, as the records of a recording, and tail bytes of an incomplete block """
+	rng = np.random.default_rng(2)
+	block = np.zeros((block_nbr, block_size), dtype=np.uint8)
+	block[:,:8] = np.arange(block_nbr, dtype='<u8').view(np.uint8).reshape(-1, 8)
+	block[:,8:] = np.cumsum(rng.integers(0, 2, (block_nbr, block_size - 8)), axis=0)
+	data = block.tobytes() + rng.integers(0, 256, tail, dtype=np.uint8).tobytes()
+	pth.write_bytes(data)
+	return data
+
+def test_round_trip() :
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		for block_nbr, tail in [(100, 0), (100, 5), (keyframe_len * 3, 0), (3, 7)] : # the last frame and the last block may be partial
+			data = make_recording(tmp_dir / "rec.reb", block_nbr, tail)
+			rbz_pth = block_compress(tmp_dir / "rec.reb", block_size, keyframe_len)
+			out_pth = block_decompress(rbz_pth, tmp_dir / "out.reb")
+			assert out_pth.read_bytes() == data, (block_nbr, tail)
+
+def test_random_access() :
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		block_nbr = 100
+		data = make_recording(tmp_dir / "rec.reb", block_nbr, 5)
+		ref = np.frombuffer(data[:block_nbr * block_size], dtype=np.uint8).reshape(-1, block_size)
+		rbz_pth = block_compress(tmp_dir / "rec.reb", block_size, keyframe_len)
+
+		with BlockReader(rbz_pth) as u :
+			assert len(u) == block_nbr and u.frame_nbr == -(-block_nbr // keyframe_len)
+			for start, stop in [(0, 1), (15, 17), (16, 32), (37, 99), (90, None), (None, None), (-10, -3), (50, 40)] :
+				assert (u.read(start, stop) == ref[start:stop]).all(), (start, stop)
+			assert u.read(50, 40).shape == (0, block_size)
+
+if __name__ == '__main__' :
+	test_round_trip()
+	test_random_access()
+	print("rbz ok")
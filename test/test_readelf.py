@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+""" the mapping built by ParserReadELF from the DWARF info of a small program, compared to the offsets
+and sizes given by the compiler itself. skipped when gcc or readelf are not available """
+
+import shutil
+import subprocess
+import tempfile
+
+from cc_pathlib import Path
+
+from structarray.parse.readelf import ParserReadELF
+
+source_txt = r'''
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+
+typedef float vec3[3];
+typedef struct { uint8_t flag; double v; } sub_t;
+typedef enum { A, B } en_t;
+struct inner { int16_t a; int32_t extra; sub_t s[2]; };
+typedef struct {
+	int x;
+	unsigned int y;
+	vec3 pos;
+	float m[2][3];
+	struct inner in;
+	sub_t * ptr;
+	en_t e;
+	union { int32_t i; float f; } u;
+	unsigned bf : 3;
+	long long ll;
+	struct { short q; } anon;
+	uint64_t big[4];
+} ctx_t;
+
+ctx_t ctx;
+
+#define OFFSET(name, expr) printf("%s\t%zu\n", name, (size_t)(expr))
+
+int main(void) {
+	OFFSET("sizeof", sizeof(ctx_t));
+	OFFSET("x", offsetof(ctx_t, x));
+	OFFSET("y", offsetof(ctx_t, y));
+	OFFSET("pos@3", offsetof(ctx_t, pos));
+	OFFSET("m[2][3]", offsetof(ctx_t, m));
+	OFFSET("in.a", offsetof(ctx_t, in) + offsetof(struct inner, a));
+	OFFSET("in.extra", offsetof(ctx_t, in) + offsetof(struct inner, extra));
+	OFFSET("in.s[2].flag", offsetof(ctx_t, in) + offsetof(struct inner, s) + offsetof(sub_t, flag));
+	OFFSET("in.s[2].v", offsetof(ctx_t, in) + offsetof(struct inner, s) + offsetof(sub_t, v));
+	OFFSET("ptr", offsetof(ctx_t, ptr));
+	OFFSET("e", offsetof(ctx_t, e));
+	OFFSET("u.i", offsetof(ctx_t, u));
+	OFFSET("u.f", offsetof(ctx_t, u));
+	OFFSET("ll", offsetof(ctx_t, ll));
+	OFFSET("anon.q", offsetof(ctx_t, anon));
+	OFFSET("big[4]", offsetof(ctx_t, big));
+	OFFSET("sizeof(sub_t)", sizeof(sub_t));
+	OFFSET("sizeof(ptr)", sizeof(sub_t *));
+	return ctx.x;
+}
+'''
+
+def test_readelf() :
+	if shutil.which('gcc') is None or shutil.which('readelf') is None :
+		print("gcc or readelf not found, skipped")
+		return
+
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		(tmp_dir / "ctx.c").write_text(source_txt)
+		subprocess.run(['gcc', '-g', '-O0', '-o', str(tmp_dir / "ctx"), str(tmp_dir / "ctx.c")], check=True)
+		offset_map = {
+			name : int(value) for name, value in (line.split('\t') for line in subprocess.run([str(tmp_dir / "ctx")], capture_output=True, text=True).stdout.splitlines())
+		}
+
+		u = ParserReadELF(tmp_dir / "ctx")
+		assert u.parse('ctx') == offset_map['sizeof']
+		meta = u.get_meta()
+
+	assert [name for name, value in meta.items()] == [
+		'x', 'y', 'pos@3', 'm[2][3]', 'in.a', 'in.extra', 'in.s[2].flag', 'in.s[2].v',
+		'ptr', 'e', 'u.i', 'u.f', 'll', 'anon.q', 'big[4]'
+	] # the bit field has no address
+	for name, (mtype, addr) in meta.items() :
+		assert addr == offset_map[name], (name, addr, offset_map[name])
+
+	type_map = {name : mtype for name, (mtype, addr) in meta.items()}
+	assert (type_map['x'], type_map['y'], type_map['pos@3'], type_map['in.s[2].v'], type_map['e'], type_map['u.f'], type_map['big[4]']) == ('Z4', 'N4', 'R4', 'R8', 'Z4', 'R4', 'N8')
+	assert type_map['ptr'] == f"P{offset_map['sizeof(ptr)']}"
+
+	# the strides of the arrays, in bytes, for each dimension
+	assert meta.array_map['pos@3'] == (4,)
+	assert meta.array_map['m[2][3]'] == (12, 4)
+	assert meta.array_map['in.s[2].flag'] == meta.array_map['in.s[2].v'] == (offset_map['sizeof(sub_t)'],)
+	assert meta.array_map['big[4]'] == (8,)
+	assert meta['m[1][2]'] == ('R4', offset_map['m[2][3]'] + 20)
+	assert meta['in.s[1].v'] == ('R8', offset_map['in.s[2].v'] + offset_map['sizeof(sub_t)'])
+
+if __name__ == '__main__' :
+	test_readelf()
+	print("readelf ok")
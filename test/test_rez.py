@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+""" round trips of a recording through a .rez archive, for each encoding of the columns, and when the
+archive is extended with records which change the encoding of some of them """
+
+import tempfile
+
+import numpy as np
+
+from cc_pathlib import Path
+
+from structarray.meta import MetaReb, ntype_map
+from structarray.rebin import RebHandler
+from structarray.rezip import RezArchiver, RezHandler
+
+array_len = 2000
+chunk_len = 300
+
+def make_column(n=array_len) :
+	rng = np.random.default_rng(1)
+	t = np.arange(n)
+	return {
+		'bit' : ('N1', rng.integers(0, 2, n)), # !
+		'bit_late' : ('N1', np.where(t > n * 3 // 4, 3, rng.integers(0, 2, n))), # ! then @
+		'grow' : ('Z4', np.where(t < n // 2, t % 50, t % 50 + 1000)), # % on N1 then on N2
+		'big' : ('Z4', np.where(t < n // 2, 7, rng.integers(-2**30, 2**30, n))), # = then @
+		'step' : ('R8', np.where(t < n // 3, 1.5, np.where(t < n // 2, 2.5, 3.5))), # ~
+		'ramp' : ('N8', 2**64 - 10 + t.astype(np.uint64) * np.uint64(3)), # /, wrapping around
+		'rampf' : ('R4', t * 0.25), # /
+		'ramp_broken' : ('Z8', np.where(t < n - 5, t * 7, 0)), # / then %
+		'same' : ('N2', np.full(n, 5)), # =
+		'neg' : ('Z8', -2**62 + (t % 200) - 100 * (t > n // 2)), # %
+	}
+
+def make_recording(tmp_dir, col) :
+	meta = MetaReb("rez_t", 0)
+	addr = 0
+	for name, (ctype, value) in col.items() :
+		meta.push(name, ctype, addr)
+		addr += int(ctype[1])
+	meta.sizeof = addr
+	meta.dump(tmp_dir / "mapping.tsv")
+
+	rec = np.zeros((len(next(iter(col.values()))[1]),), dtype=np.dtype({
+		'names' : list(col),
+		'formats' : [ntype_map[ctype] for ctype, value in col.values()],
+		'offsets' : [meta[name][1] for name in col],
+		'itemsize' : meta.sizeof
+	}))
+	for name, (ctype, value) in col.items() :
+		rec[name] = value.astype(ntype_map[ctype])
+	return rec
+
+def archive(tmp_dir, rec, length, append=False) :
+	""" write the first length records in rec.reb and archive them, return the encoding of each column """
+	(tmp_dir / "rec.reb").write_bytes(rec[:length].tobytes())
+	reb = RebHandler().load(tmp_dir / "rec.reb")
+	with RezHandler().load(reb.to_rez(chunk_len, append)) as rez :
+		assert rez.meta.array_len == length
+		for name in rec.dtype.names :
+			assert rez[name].tobytes() == rec[name][:length].tobytes(), (name, rez.meta[name])
+		for start, stop in [(0, 3), (length // 3, length // 2), (length - 7, None)] : # windows across the chunks
+			res_map = rez.get_many(rec.dtype.names, start, stop)
+			for name in rec.dtype.names :
+				assert res_map[name].tobytes() == rec[name][:length][start:stop].tobytes(), (name, start, stop)
+		return {name : rez.meta[name][1] for name in rec.dtype.names}
+
+def test_encoding() :
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		rec = make_recording(tmp_dir, make_column())
+		z_map = archive(tmp_dir, rec, array_len)
+		assert z_map == {
+			'bit' : '!', 'bit_late' : '@', 'grow' : '%', 'big' : '@', 'step' : '~',
+			'ramp' : '/', 'rampf' : '/', 'ramp_broken' : '%', 'same' : '=', 'neg' : '%',
+		}
+
+def test_append() :
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		rec = make_recording(tmp_dir, make_column())
+		z_map = archive(tmp_dir, rec, array_len // 4)
+		assert (z_map['bit_late'], z_map['big'], z_map['ramp_broken']) == ('!', '=', '/')
+		archive(tmp_dir, rec, array_len // 2 + 3, append=True)
+		z_map = archive(tmp_dir, rec, array_len, append=True)
+		assert (z_map['bit_late'], z_map['big'], z_map['ramp_broken']) == ('@', '@', '%')
+
+def test_append_size() :
+	# the rows of a small archive are extended to the size of a fresh archive of the whole recording
+	n = 200000
+	with tempfile.TemporaryDirectory() as tmp_dir :
+		tmp_dir = Path(tmp_dir)
+		rec = make_recording(tmp_dir, make_column(n))
+		(tmp_dir / "rec.reb").write_bytes(rec[:50].tobytes())
+		RebHandler().load(tmp_dir / "rec.reb").to_rez()
+		(tmp_dir / "rec.reb").write_bytes(rec.tobytes())
+		append_size = RebHandler().load(tmp_dir / "rec.reb").to_rez(append=True).stat().st_size
+		archive_size = RebHandler().load(tmp_dir / "rec.reb").to_rez().stat().st_size
+		assert append_size < 1.1 * archive_size, (append_size, archive_size)
+
+def test_eviction() :
+	RezArchiver.run_size, run_size = 40, RezArchiver.run_size # too small for the runs of step
+	try :
+		with tempfile.TemporaryDirectory() as tmp_dir :
+			tmp_dir = Path(tmp_dir)
+			rec = make_recording(tmp_dir, make_column())
+			assert archive(tmp_dir, rec, array_len)['step'] == '@'
+	finally :
+		RezArchiver.run_size = run_size
+
+if __name__ == '__main__' :
+	test_encoding()
+	test_append()
+	test_append_size()
+	test_eviction()
+	print("rez ok")